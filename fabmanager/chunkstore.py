@@ -0,0 +1,200 @@
+# encoding: utf-8
+# Content-addressed store of file trees, used for incremental backups of extra_backup_files
+#
+# Files are split in fixed-size chunks, each one stored (locally) under its sha256. A snapshot
+# is a JSON manifest listing, for each file, its size, mode, mtime and chunks. This module is
+# used both locally, by fabfile.py, and at the server, as a standalone script (Python 3, stdlib
+# only), uploaded and invoked by fabfile.py:
+#
+#   python3 chunkstore.py scan <cache> <path> [<path> ...]  Prints manifest of paths, reusing hashes
+#                                                           of files whose size/mtime did not change
+#   python3 chunkstore.py pack <cache>                      Reads hashes from stdin, writes their chunks
+#   python3 chunkstore.py unpack <manifest>                 Reads chunks of files in manifest from stdin,
+#                                                           and writes the files (none, if any chunk is bad)
+
+import hashlib
+import json
+import os
+import sys
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def _chunk_sizes(size):
+    """Sizes of the chunks of a file of given size"""
+    sizes = [CHUNK_SIZE] * (size // CHUNK_SIZE)
+    if size % CHUNK_SIZE or not size:
+        sizes.append(size % CHUNK_SIZE)
+    return sizes
+
+def _hash_file(path):
+    """List of sha256 of the chunks of file"""
+    with open(path, 'rb') as input:
+        data = input.read(CHUNK_SIZE)
+        chunks = [hashlib.sha256(data).hexdigest()]
+        while len(data) == CHUNK_SIZE:
+            data = input.read(CHUNK_SIZE)
+            if data:
+                chunks.append(hashlib.sha256(data).hexdigest())
+    return chunks
+
+def _load_json(filename, default):
+    """Contents of JSON file, or default if it does not exist"""
+    try:
+        with open(filename, 'r') as input:
+            return json.load(input)
+    except (IOError, ValueError):
+        return default
+
+def _save_json(filename, data):
+    """Saves JSON file, atomically"""
+    temp_file = '%s.%d' % (filename, os.getpid())
+    with open(temp_file, 'w') as output:
+        json.dump(data, output, indent=1, sort_keys=True)
+    os.replace(temp_file, filename)
+
+def scan(cache_file, paths):
+    """Manifest of all files under paths, reusing hashes in cache_file for files that did not change"""
+    cache = _load_json(cache_file, {})
+    files = {}
+    for top in paths:
+        for root, dirs, filenames in os.walk(top) if os.path.isdir(top) else [('', [], [top])]:
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                cached = cache.get(path, None)
+                if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                    chunks = cached['chunks']
+                else:
+                    chunks = _hash_file(path)
+                files[path] = {
+                    'size': stat.st_size,
+                    'mode': stat.st_mode & 0o7777,
+                    'mtime': stat.st_mtime,
+                    'chunks': chunks,
+                }
+    _save_json(cache_file, files)
+    return {'chunk_size': CHUNK_SIZE, 'files': files}
+
+def pack(cache_file, hashes, output):
+    """Writes to output the chunks (found through cache_file) with given hashes, in the same order"""
+    locations = {}
+    for path, info in _load_json(cache_file, {}).items():
+        for index, chunk in enumerate(info['chunks']):
+            locations.setdefault(chunk, (path, index))
+    for chunk in hashes:
+        path, index = locations[chunk]
+        with open(path, 'rb') as input:
+            input.seek(index * CHUNK_SIZE)
+            output.write(input.read(CHUNK_SIZE))
+
+def unpack(manifest, input):
+    """
+    Rebuilds files in manifest, reading their chunks, in order, from input. Each chunk is checked
+    against its size and hash, and files are replaced only once all of them were received intact
+    """
+    temp_files = []
+    try:
+        for path, info in sorted(manifest['files'].items()):
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            temp_file = '%s.chunkstore' % path
+            temp_files.append((temp_file, path))
+            with open(temp_file, 'wb') as output:
+                for chunk, size in zip(info['chunks'], _chunk_sizes(info['size'])):
+                    data = input.read(size)
+                    if len(data) != size or hashlib.sha256(data).hexdigest() != chunk:
+                        raise ValueError('Corrupted or incomplete chunk %s of %s' % (chunk, path))
+                    output.write(data)
+            os.chmod(temp_file, info['mode'])
+            os.utime(temp_file, (info['mtime'], info['mtime']))
+    except BaseException:
+        for temp_file, path in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        raise
+    for temp_file, path in temp_files:
+        os.replace(temp_file, path)
+
+def object_path(store_dir, chunk):
+    """Location of chunk in the (local) store"""
+    return os.path.join(store_dir, 'objects', chunk[:2], chunk)
+
+def missing_chunks(store_dir, manifest):
+    """List of (hash, size) of the chunks of manifest not yet in the store, without repetitions"""
+    missing = []
+    seen = set()
+    for path, info in sorted(manifest['files'].items()):
+        for chunk, size in zip(info['chunks'], _chunk_sizes(info['size'])):
+            if chunk not in seen and not os.path.exists(object_path(store_dir, chunk)):
+                missing.append((chunk, size))
+            seen.add(chunk)
+    return missing
+
+def store_chunk(store_dir, chunk, data):
+    """Verifies and stores chunk"""
+    if hashlib.sha256(data).hexdigest() != chunk:
+        raise ValueError('Corrupted chunk %s' % chunk)
+    filename = object_path(store_dir, chunk)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as output:
+        output.write(data)
+
+def read_chunks(store_dir, manifest):
+    """Generates the (verified) contents of all chunks of all files in manifest, in unpack() order"""
+    for path, info in sorted(manifest['files'].items()):
+        for chunk in info['chunks']:
+            if not os.path.exists(object_path(store_dir, chunk)):
+                raise ValueError('Missing chunk %s of %s' % (chunk, path))
+            with open(object_path(store_dir, chunk), 'rb') as input:
+                data = input.read()
+            if hashlib.sha256(data).hexdigest() != chunk:
+                raise ValueError('Corrupted chunk %s of %s' % (chunk, path))
+            yield data
+
+def check_chunks(store_dir, manifest):
+    """Verifies that all chunks of all files in manifest are in the store, and intact (raises ValueError if not)"""
+    for data in read_chunks(store_dir, manifest):
+        pass
+
+def snapshot_path(store_dir, name):
+    """Location of a snapshot manifest in the (local) store"""
+    return os.path.join(store_dir, 'snapshots', '%s.json' % name)
+
+def save_snapshot(store_dir, name, manifest):
+    """Saves snapshot manifest in the (local) store"""
+    if not os.path.exists(os.path.join(store_dir, 'snapshots')):
+        os.makedirs(os.path.join(store_dir, 'snapshots'))
+    _save_json(snapshot_path(store_dir, name), manifest)
+
+def load_snapshot(store_dir, name):
+    """Snapshot manifest from the (local) store, or None"""
+    return _load_json(snapshot_path(store_dir, name), None)
+
+def list_snapshots(store_dir):
+    """Names of all snapshots in the (local) store"""
+    snapshots_dir = os.path.join(store_dir, 'snapshots')
+    if not os.path.exists(snapshots_dir):
+        return []
+    return sorted([filename[:-len('.json')] for filename in os.listdir(snapshots_dir) if filename.endswith('.json')])
+
+def main(argv):
+    """Invoked at the server, see commands above"""
+    command = argv[1]
+    if command == 'scan':
+        json.dump(scan(argv[2], argv[3:]), sys.stdout)
+    elif command == 'pack':
+        pack(argv[2], [line.strip() for line in sys.stdin if line.strip()], sys.stdout.buffer)
+    elif command == 'unpack':
+        try:
+            unpack(_load_json(argv[2], {'files': {}}), sys.stdin.buffer)
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        sys.exit('Unknown command: %s' % command)
+
+if __name__ == '__main__':
+    main(sys.argv)
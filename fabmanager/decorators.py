@@ -1,15 +1,28 @@
 # encoding: utf-8
 # Useful decorators
 
+import io
+import shlex
+import sys
+import time
+
 from functools import wraps
 
 from fabric.api import *
 
+from fabmanager import instrumentation
+
 # These variables must be defined in the actual fabfile.py for the proxy decorators:
 # env.proxy_server = 'proxy.com.br'     Address of the proxy server intermediating the executation
 # env.proxy_home   = '/home/me/fabric'  Location, at the proxy server, where fabfily.py will reside
 # env.proxy_host   = 'somehost'         Host or role specified for this session - will be included
 # env.proxy_role   = 'somerole'           in the fab command executed at the proxy server
+#
+# Optionally:
+# env.proxy_mode      = 'gateway'  Instead of invoking fab at the proxy server for each task, runs tasks locally,
+#                                  reaching the servers through a single SSH connection to the proxy server
+#                                  (Fabric's gateway), reused by all tasks of the session
+# env.proxy_pool_size = 5          Max. number of servers of a role handled simultaneously, in gateway mode
 
 def _is_running_on_proxy():
     """
@@ -53,29 +66,138 @@ def _run_on_proxy(role=None, host=None):
                 # have higher priority.
 
                 # If a role or host parameter was specified for the decorator, use it
+                target = {}
                 if role:
-                    kwargs['role'] = role
+                    target['role'] = role
                 elif host:
-                    kwargs['host'] = host
+                    target['host'] = host
                 # If some previous task populated env.proxy_role or proxy_host, use it
                 elif env.proxy_role:
-                    kwargs['role'] = env.proxy_role
+                    target['role'] = env.proxy_role
                 elif env.proxy_host:
-                    kwargs['host'] = env.proxy_host
+                    target['host'] = env.proxy_host
 
+                if env.get('proxy_mode', None) == 'gateway':
+                    return _run_through_gateway(task, target, *args, **kwargs)
                 with cd(env.proxy_home):
-                    arguments = []
-                    if args:
-                        arguments.append(','.join(args))
-                    if kwargs:
-                        arguments.append(','.join(['%s=%s' % (k,v) for k,v in kwargs.items()]))
-                    if args or kwargs:
-                        run('fab %s:%s' % (task.__name__, ','.join(arguments)))
-                    else:
-                        run('fab %s' % task.__name__)
+                    run('fab %s' % shlex.quote(_fab_task(task.__name__, args, dict(kwargs, **target))))
             else:
                 task(*args, **kwargs)
 
         return wrapper
 
     return actual_decorator
+
+def _fab_argument(value):
+    """
+    Escapes a task argument for fab's command line (task:arg,key=value), where commas
+    and equal signs separate arguments.
+    """
+    return str(value).replace(',', r'\,').replace('=', r'\=')
+
+def _fab_task(name, args, kwargs):
+    """
+    Task invocation for fab's command line, e.g.: mytask:1,2,key=value
+    """
+    arguments = [_fab_argument(arg) for arg in args]
+    arguments += ['%s=%s' % (k, _fab_argument(v)) for k, v in sorted(kwargs.items())]
+    return '%s:%s' % (name, ','.join(arguments)) if arguments else name
+
+def _run_through_gateway(task, target, *args, **kwargs):
+    """
+    Runs task locally on the servers specified by target (role or host), connecting to them
+    through the proxy server. Connections (to the proxy and to the servers) are kept by Fabric
+    for the rest of the session. The servers of a role are handled simultaneously.
+    """
+    if 'role' in target:
+        targets = {'roles': [target['role']]}
+        hosts = env.roledefs.get(target['role'], [])
+        hosts = hosts.get('hosts', []) if isinstance(hosts, dict) else hosts
+    else:
+        targets = {'hosts': [target['host']]}
+        hosts = [target['host']]
+    if len(hosts) > 1:
+        task = parallel(pool_size=int(env.get('proxy_pool_size', None) or FAN_OUT_POOL_SIZE))(task)
+    with settings(gateway=env.proxy_server):
+        return execute(task, *args, **dict(kwargs, **targets))
+
+# Default number of hosts handled simultaneously by @_fan_out tasks, unless the
+# environment defines 'pool_size' in ENVS or it's given with fab -z
+FAN_OUT_POOL_SIZE = 5
+
+def _fan_out(task):
+    """
+    Decorator that runs a task on all hosts of the environment at once, using a
+    bounded pool of worker processes.
+
+    Usage:
+
+        @_fan_out
+        def mytask():
+
+    When the task is invoked from the command line and the environment has more
+    than one host (see 'hosts' and 'roles' in ENVS), the first host iteration made
+    by Fabric fans the task out to all hosts, and the remaining iterations are
+    skipped. Output of each host is kept together and printed when that host is done,
+    followed by a summary of successes/failures by host at the end.
+
+    If the task is called by some other task (e.g.: setup_project calling update_project),
+    or if there is a single host, or if fab was called with -P, just execute the task.
+    """
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        """
+        Wrapper that decides whether to fan out or to just execute the task.
+        """
+        all_hosts = env.get('all_hosts') or []
+        if env.command != task.__name__ or len(all_hosts) < 2 or env.parallel:
+            return task(*args, **kwargs)
+        if env.host_string != all_hosts[0]:
+            return
+
+        pool_size = env.get('project', {}).get('pool_size', None) or env.pool_size or FAN_OUT_POOL_SIZE
+        grouped_task = parallel(pool_size=int(pool_size))(_grouped_output(task))
+        results = execute(grouped_task, *args, hosts=all_hosts, **kwargs)
+
+        print('\nSummary for %s:' % task.__name__)
+        failed = []
+        for host in all_hosts:
+            succeeded, elapsed, operations = results.get(host, None) or (False, 0, [])
+            instrumentation.merge(operations)
+            print('    %-40s %-10s %6.1fs' % (host, 'ok' if succeeded else 'FAILED', elapsed))
+            if not succeeded:
+                failed.append(host)
+        if failed:
+            abort('%s failed on %d of %d hosts: %s' % (task.__name__, len(failed), len(all_hosts), ', '.join(failed)))
+
+    return wrapper
+
+def _grouped_output(task):
+    """
+    Wraps a task so that, when run in a worker process, its output is buffered
+    and printed all at once. Returns (succeeded, elapsed seconds, remote operations
+    recorded for run reports) instead of raising, so that a failure on one host does
+    not hide the results of the others, and the operations are not lost with the worker.
+    """
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        recorded = len(instrumentation.OPERATIONS)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = buffer = io.StringIO()
+        start = time.time()
+        try:
+            task(*args, **kwargs)
+            succeeded = True
+        except (Exception, SystemExit) as e:
+            if not isinstance(e, SystemExit):
+                sys.stderr.write('\nFatal error: %s\n' % e)
+            succeeded = False
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        elapsed = time.time() - start
+        sys.stdout.write('\n[%s] ---- %s (%s) ----\n%s' % (
+            env.host_string, task.__name__, 'ok' if succeeded else 'FAILED', buffer.getvalue()))
+        sys.stdout.flush()
+        return succeeded, elapsed, instrumentation.OPERATIONS[recorded:]
+
+    return wrapper
@@ -5,13 +5,37 @@
 import urllib
 
 import os
+import collections
+import csv
 import datetime
+import difflib
+import fcntl
+import functools
+import getpass
+import hashlib
+import heapq
 import io
+import json
+import queue
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from fabric.api import *
 from fabric.contrib import django
 from fabric.contrib import files
 from fabric.contrib import console
+from fabric.state import connections
+
+from fabmanager import chunkstore
+from fabmanager import instrumentation
+from fabmanager import logsearch
+from fabmanager import sampler
+from fabmanager.decorators import _fan_out
 
 try:
     from django.conf import settings as django_settings
@@ -22,12 +46,24 @@ except:
 fabmanager_dir = os.path.dirname(os.path.abspath(__file__))
 templates_dir  = os.path.join(fabmanager_dir, 'templates/fabmanager/')
 
+# Templates already read (see _render_conf)
+TEMPLATES = {}
+
 # Environments - to be extended with ENVS.update()
 ENVS = {}
 
 # Linux
-NEWEST_GIT_VERSION  = "curl -s http://git-scm.com/ | python -c \"import sys; from bs4 import BeautifulSoup; soup=BeautifulSoup(''.join(sys.stdin.readlines())); print(soup.find(class_='version').text.strip())\""
+NEWEST_GIT_VERSION  = "git ls-remote --tags --refs https://git.kernel.org/pub/scm/git/git.git 'v*'"
 LOCAL_GIT_VERSION   = "git --version | cut -d ' ' -f 3"
+GIT_SOURCE_URL      = 'https://www.kernel.org/pub/software/scm/git/git-%s.tar.gz'
+OS_PLATFORM         = '. /etc/os-release && echo $ID-$VERSION_ID-$(uname -m)'
+
+# Local cache of build artifacts (e.g.: git built from source), by version, OS and architecture, and Debian packages
+# of the shared libraries that binaries under a dir need at runtime (see _runtime_packages)
+ARTIFACTS_DIR       = '../backup/artifacts'
+RUNTIME_PACKAGES    = "find %s -type f \\( -perm -u+x -o -name '*.so*' \\) -exec ldd {} + 2>/dev/null | " \
+                      "awk '/=> \\// {print $3}' | sort -u | while read lib; do dpkg -S $lib 2>/dev/null || " \
+                      "dpkg -S ${lib#/usr} 2>/dev/null; done | grep -v '^diversion' | cut -d: -f1 | sort -u"
 
 # Python
 GET_PYTHON_VERSION  = "python -V 2>&1 | cut -f2 -d' ' | cut -f-2 -d."
@@ -52,10 +88,154 @@ STATIC_DIR          = '%(workon)s/%(virtualenv)s/%(project)s/static'
 APACHE_CONF         = CONFIG_DIR+'/apache_%(environment)s.conf'
 WSGI_CONF           = CONFIG_DIR+'/wsgi_%(environment)s.py'
 
+# mod_wsgi sizing (see _wsgi_sizing): defaults for ENVS 'wsgi_*' entries, share of memory given to
+# WSGI processes (the rest is for MySQL, Apache, etc.), and probes of capacity and of the RSS of the app
+WSGI_THREADS            = 15
+WSGI_MAXIMUM_REQUESTS   = 1000
+WSGI_QUEUE_TIMEOUT      = 45
+WSGI_INACTIVITY_TIMEOUT = 300
+WSGI_MEMORY_SHARE       = 0.5
+WSGI_RSS_GROWTH         = 1.5
+WSGI_DEFAULT_RSS_MB     = 150
+MPM_THREADS_PER_CHILD   = 25
+CAPACITY_PROBE          = "nproc && awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo"
+APP_RSS_PROBE           = "python -c \"import resource; from django.core.wsgi import get_wsgi_application; " \
+                          "get_wsgi_application(); print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)\""
+
+# Rolling restarts (see rolling_restart): defaults for ENVS 'rolling_min_capacity', 'health_url', 'health_budget'
+# (seconds a healthy response may take) and 'health_timeout' (seconds a host may take to become healthy)
+ROLLING_MIN_CAPACITY    = 0.5
+HEALTH_URL              = '/'
+HEALTH_BUDGET           = 2.0
+HEALTH_TIMEOUT          = 60
+HEALTH_PROBE            = "curl -s -o /dev/null -m %(budget)s -H 'Host: %(host)s' -w '%%{http_code} %%{time_total}' " \
+                          "http://127.0.0.1%(url)s"
+
+# Warm-up after a reset (see warm_up): each of ENVS 'warmup_urls' is requested at the server by as many concurrent
+# requests as WSGI threads of all processes, twice (cold, then warm); and code added to the WSGI file by ENVS
+# 'wsgi_preload', to load URLconf and views at process start (django.core.urlresolvers before Django 1.10)
+WSGI_PRELOAD            = "\n# Loads URLconf and views at process start, instead of at the first request (ENVS 'wsgi_preload')\n" \
+                          "try:\n" \
+                          "    from django.urls import get_resolver\n" \
+                          "except ImportError:\n" \
+                          "    from django.core.urlresolvers import get_resolver\n" \
+                          "get_resolver(None).url_patterns"
+WARMUP_TIMEOUT          = 30
+WARMUP_PROBE            = "for i in $(seq %(concurrency)s); do printf '%%s\\n' %(urls)s; done | xargs -P %(concurrency)s -I{} " \
+                          "curl -s -o /dev/null -m %(timeout)s -H 'Host: %(host)s' -w '{} %%{http_code} %%{time_total}\\n' " \
+                          "http://127.0.0.1{}"
+
 # MySQL
 MYSQL_PREFIX        = 'mysql -u root -p -e %s'
-
-PIP_INSTALL_PREFIX  = 'pip install -r %(project)s/required-packages.pip'
+MYSQL_PWD_PREFIX    = 'MYSQL_PWD=%s mysql -u root -e %s'
+MYSQLDUMP_COMMAND   = "mysqldump --no-tablespaces %(host)s -u %(USER)s -p'%(PASSWORD)s' %(NAME)s"
+MYSQL_TABLES_QUERY  = "SELECT table_name, table_type, table_rows, data_length FROM information_schema.tables " \
+                      "WHERE table_schema='%(NAME)s'"
+
+# MySQL tuning (see tune_mysql): fragment of my.cnf, and how much of the memory (not taken by WSGI processes, unless
+# MySQL has a server of its own, see ENVS 'mysql_host') goes to the InnoDB buffer pool, which is anyway not much larger
+# than the data
+MYSQL_TUNING_CNF    = '/etc/mysql/conf.d/fabmanager.cnf'
+MYSQL_SIZE_QUERY    = "SELECT VERSION(), COALESCE(SUM(data_length + index_length), 0) DIV 1048576 " \
+                      "FROM information_schema.tables WHERE table_schema='%(NAME)s'"
+MYSQL_MEMORY_SHARE  = 0.75
+MYSQL_DATA_GROWTH   = 1.5
+
+# Per-table backups: splits a mysqldump stream into one gzipped file per table, repeating the header
+# (charset, etc.) of the dump at the beginning of each file
+SPLIT_DUMP_SCRIPT   = "awk '" \
+                      "/^-- Table structure for table `/ {" \
+                      "  if (cmd) close(cmd); name = $0;" \
+                      "  sub(/^-- Table structure for table `/, \"\", name); sub(/`.*$/, \"\", name);" \
+                      "  cmd = \"gzip --rsyncable -c > %s/\" name \".sql.gz\";" \
+                      "  for (i = 1; i <= n; i++) print header[i] | cmd" \
+                      "}" \
+                      "{ if (cmd) print | cmd; else header[++n] = $0 }'"
+
+# Per-table backups: file of views (table names can't contain '.', so it's never taken by a table), columns of the
+# manifest (rows are counted in the same snapshot as the dumps) and output of mysqldump -v once its transaction
+# (snapshot) has started
+VIEWS_DUMP_FILE     = 'tables/.views.sql.gz'
+MANIFEST_HEADER     = '#table\ttype\trows\tsha256\tfile'
+DUMP_STARTED_LOG    = '^-- Retrieving'
+
+# Streaming backups: compressor -> (command, with default level, file extension)
+COMPRESSORS = {
+    'zstd': ('zstd -q -T0 -%(level)s -c', 3, 'zst'),
+    'pigz': ('pigz -%(level)s -c', 6, 'gz'),
+}
+STREAM_CHUNK_SIZE   = 1024 * 1024
+STREAM_BYTES_MARKER = '@@fabmanager-bytes'
+
+# Transfers of backups: rsync exit codes worth retrying (connection dropped, timeouts), and number of retries
+RSYNC_RETRY_CODES   = (10, 12, 20, 23, 30, 35, 255)
+RSYNC_RETRIES       = 5
+
+# Restores: relaxes checks for the loading sessions, and redo log flushing for the server meanwhile
+RESTORE_WORKERS     = 4
+RESTORE_SESSION_SQL = 'SET SESSION foreign_key_checks=0, unique_checks=0;'
+RESTORE_FLUSH_LOG   = 'innodb_flush_log_at_trx_commit'
+RESTORE_TIME_MARKER = '@@fabmanager-table'
+
+# Dir at the server for fabmanager's helper scripts (e.g.: chunkstore.py) and their data
+REMOTE_HELPERS_DIR  = '~/.fabmanager'
+
+# Incremental backups of extra_backup_files: local content-addressed store, and cache of hashes at the server
+BACKUP_STORE_DIR    = '../backup/store'
+CHUNKSTORE_CACHE    = REMOTE_HELPERS_DIR + '/chunkstore-%(environment)s.json'
+
+# Log search: index at the server
+LOG_DIR             = '%(workon)s/%(virtualenv)s/log'
+LOG_INDEX           = REMOTE_HELPERS_DIR + '/logindex-%(environment)s'
+
+# Resource sampling: max. samples kept per host, and metrics summarized at the end
+SAMPLES_BUFFER      = 3600
+SAMPLES_METRICS     = ['cpu', 'iowait', 'load', 'memory_mb', 'swap_mb',
+                       'disk_read_mbs', 'disk_write_mbs', 'net_in_mbs', 'net_out_mbs']
+
+# Log follow: max. lines waiting to be shown (more are dropped), and how long lines wait to be sorted by timestamp
+LOG_FOLLOW_BUFFER   = 10000
+LOG_FOLLOW_WINDOW   = 1.0
+
+PIP_REQUIREMENTS    = '%(project)s/required-packages.pip'
+PIP_INSTALL_PREFIX  = 'pip install -r ' + PIP_REQUIREMENTS
+
+# Wheelhouse for pip_install: local cache of wheel archives, and key of the one installed at the virtualenv
+WHEELHOUSE_DIR      = '../backup/wheelhouse'
+WHEELHOUSE_MARKER   = VIRTUALENV_DIR + '/.wheelhouse'
+
+# Git objects shared by all environments at a server (see ENVS 'git_shared_objects'), one bare repo per git_repo
+GIT_SHARED_DIR      = REMOTE_HELPERS_DIR + '/git'
+
+# Releases: local store of artifacts, dir at the server (project's dir becomes a symlink to one of them),
+# media shared by all releases, and number of releases kept at the server for rollback (unless ENVS 'releases')
+RELEASES_STORE_DIR  = '../backup/releases'
+RELEASES_DIR        = VIRTUALENV_DIR + '/releases'
+SHARED_MEDIA_DIR    = VIRTUALENV_DIR + '/shared/media'
+RELEASES_KEEP       = 5
+RELEASE_SETTINGS    = "from %(project)s.%(settings)s import *\nSTATIC_ROOT = %(static_root)r\n"
+
+# Batching: marks beginning/end of each step in the output of a batched script
+BATCH_STEP_MARKER   = '@@fabmanager-step'
+
+# State store at each host: steps already done (user, virtualenv, git clone, etc.), with a fingerprint of their inputs
+STATE_FILE          = REMOTE_HELPERS_DIR + '/state.json'
+HOST_STATES         = {}
+
+# Local cache of facts about remote hosts (Python/Django versions, database, etc.)
+FACTS_FILE          = os.path.expanduser('~/.fabmanager/facts.json')
+FACTS_TTL           = 24 * 60 * 60
+
+# Provisioning: apt packages needed by each install_* task (bootstrap installs all of them at once)
+APT_PACKAGES = collections.OrderedDict([
+    ('python', ['python', 'python2.7', 'python2.7-dev', 'pkg-config', 'gcc', 'python-setuptools', 'python-bs4']),
+    ('git',    ['build-essential', 'git-core', 'libcurl4-gnutls-dev', 'libexpat1-dev', 'gettext', 'libz-dev',
+                'libssl-dev']),
+    ('apache', ['apache2', 'apache2-mpm-worker', 'libapache2-mod-wsgi']),
+    ('mysql',  ['mysql-server', 'libmysqlclient-dev']),
+])
+APT_INSTALL         = 'DEBIAN_FRONTEND=noninteractive apt-get -y -qq install %s'
+APT_UPDATE_DONE     = '${TMPDIR:-/tmp}/apt-get-update-done'
 
 # Aliases for common tasks at server
 ALIASES = dict(
@@ -83,11 +263,18 @@ def _setup_environment(environment):
     env.forward_agent = True    
     env.environment   = environment
     env.project       = ENVS[environment]
-    env.hosts         = [env.project['host']]
+    env.hosts         = list(env.project.get('hosts', []))
+    env.roles         = list(env.project.get('roles', {}).keys())
+    env.roledefs.update(env.project.get('roles', {}))
+    if not env.hosts and not env.roles:
+        env.hosts     = [env.project['host']]
     env.user          = env.project.get('user', env.local_user)
     env.password      = env.project.get('password', None)
     # Redundant, just to easy the interpolation later on
     env.project['environment'] = environment
+    # Times every remote operation, see instrumentation.py
+    if env.project.get('run_reports', False):
+        instrumentation.install()
 
 def _require_environment():
     """Checks if env.environment and env.host exist"""
@@ -108,32 +295,252 @@ def _parse_alias(command):
     else:
         return '%s %s' % (ALIASES[words[0]], ' '.join(words[1:]))
 
+def _is_true(value):
+    """Interprets task parameters given at the command line (e.g.: fab task:batch=yes)"""
+    return str(value).lower() in ('1', 'y', 'yes', 'true', 'on')
+
+def _batch_mode(batch):
+    """Should commands be batched? Task parameter has precedence over ENVS 'batch'"""
+    if batch is None:
+        return bool(env.project.get('batch', False))
+    return _is_true(batch)
+
+def _run_batch(steps):
+    """
+    Runs a list of (command, warn_only, use_sudo) steps as a single remote script, that is,
+    in one round trip, with a single activation of the current prefix (virtualenv, etc.)
+
+    Each step runs in its own subshell, as if it was a separate run()/sudo(), and has its
+    exit code and output reported separately. A failing step aborts the whole batch,
+    unless it is warn_only. Returns a list of (command, return code, output) for each
+    step actually executed.
+    """
+    script = []
+    for index, (command, warn_only, use_sudo) in enumerate(steps):
+        if use_sudo:
+            command = _sudo_command(command)
+        # Markers go on lines of their own, even if output (of the prefix, or of a step) lacks a final newline
+        script.append('echo; echo %s %d' % (BATCH_STEP_MARKER, index))
+        script.append('(%s)' % command)
+        script.append('rc=$?; echo; echo %s %d $rc' % (BATCH_STEP_MARKER, index))
+        if not warn_only:
+            script.append('[ $rc -eq 0 ] || exit $rc')
+
+    with settings(hide('stdout', 'warnings'), warn_only=True):
+        result = run('(\n%s\n)' % '\n'.join(script))
+
+    # Splits output by step (the step's index comes from the marker), dropping the newline added before the marker
+    results = []
+    current = None
+    last = None
+    for line in result.splitlines():
+        words = line.strip().split(' ')
+        if words[0] == BATCH_STEP_MARKER and len(words) == 2:
+            current = []
+        elif words[0] == BATCH_STEP_MARKER and len(words) == 3 and current is not None:
+            if current and not current[-1].strip():
+                current.pop()
+            last = int(words[1])
+            results.append((steps[last][0], int(words[2]), '\n'.join(current)))
+            current = None
+        elif current is not None:
+            current.append(line)
+
+    for index, (command, return_code, output) in enumerate(results):
+        print('[%s] batch %d/%d: %s (exit code %d)' % (env.host_string, index + 1, len(steps), command, return_code))
+        if output:
+            print(output)
+    if result.failed:
+        if not results or results[-1][1] == 0:
+            abort('Batch failed before its first step: %s' % result)
+        if not steps[last][1]:
+            abort('Batch step failed: %s' % results[-1][0])
+    return results
+
+def _sudo_command(command):
+    """Command line that runs command with sudo, like sudo() does (that is, including redirections, &&, etc.)"""
+    return '%s/bin/bash -c %s' % (env.sudo_prefix % env, shlex.quote(command))
+
+def _concurrently(groups):
+    """
+    Single step (for _run_batch) that runs groups of (command, warn_only, use_sudo) steps at once, failing if any
+    of them fails. Steps of a group depend on each other: they run one after the other, up to the first failure
+    (of a step that isn't warn_only).
+    """
+    script = []
+    for steps in groups:
+        commands = [('( (%s) || true )' if warn_only else '(%s)') % (_sudo_command(command) if use_sudo else command)
+                    for command, warn_only, use_sudo in steps]
+        script.append('( %s ) & pids="$pids $!"' % ' && '.join(commands))
+    script.append('rc=0; for pid in $pids; do wait $pid || rc=1; done; exit $rc')
+    return ('\n'.join(script), False, False)
+
+def _run_steps(steps, batch):
+    """Runs a list of (command, warn_only, use_sudo) steps, either batched or one by one"""
+    if batch:
+        return _run_batch(steps)
+    for command, warn_only, use_sudo in steps:
+        with settings(warn_only=warn_only):
+            if use_sudo:
+                sudo(command)
+            else:
+                run(command)
+
 def _generate_conf(conf_file, variables, django_version):
     """Generates conf file from template, and optionally saves it"""
+    conf = _render_conf(conf_file, variables, django_version)
+    output_file = _conf_output_file(conf_file)
+
+    # Shows conf file and optionally saves it
+    print(conf)
+    if console.confirm('Save to %s?' % output_file, default=False):
+        with open(output_file, 'w') as output:
+            output.write(conf)
+
+def _render_conf(conf_file, variables, django_version):
+    """Renders conf file (e.g.: 'apache.conf') from template, read only once per session"""
     if not django_version:
         django_version = DJANGO_LATEST_VERSION
-
-    # File names
     part = conf_file.split('.')
     input_file = os.path.join(templates_dir, '%s_django%s.%s' % (part[0], django_version, part[1]))
-    output_file = '%s/%s_%s.%s' % (env.project['project'], part[0], env.environment, part[1])
+    if input_file not in TEMPLATES:
+        with open(input_file, 'r') as input:
+            TEMPLATES[input_file] = input.read()
+    return TEMPLATES[input_file] % variables
+
+def _conf_output_file(conf_file):
+    """Location of an environment's conf file (e.g.: 'apache.conf') in the project"""
+    part = conf_file.split('.')
+    return '%s/%s_%s.%s' % (env.project['project'], part[0], env.environment, part[1])
+
+
+###############
+# Facts cache #
+###############
+
+def _facts_key():
+    """Facts are kept by host + virtualenv"""
+    return '%s:%s' % (env.host_string, _interpolate(VIRTUALENV_DIR))
 
-    # Generate conf file from template
-    conf = ''
-    output = io.StringIO()
+def _load_facts():
+    """Loads all cached facts from local disk"""
     try:
-        with open(input_file, 'r') as input:
-            for line in input:
-                output.write(line % variables)
-        conf = output.getvalue()
-    finally:
-        output.close()
+        with open(FACTS_FILE, 'r') as input:
+            return json.load(input)
+    except (IOError, ValueError):
+        return {}
+
+def _save_facts(facts):
+    """Saves all cached facts to local disk, atomically (facts may contain database passwords)"""
+    facts_dir = os.path.dirname(FACTS_FILE)
+    if not os.path.exists(facts_dir):
+        os.makedirs(facts_dir, 0o700)
+    temp_file = '%s.%d' % (FACTS_FILE, os.getpid())
+    with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as output:
+        json.dump(facts, output, indent=2, sort_keys=True, default=str)
+    os.replace(temp_file, FACTS_FILE)
+
+def _get_fact(name, probe):
+    """Returns fact from the cache, if not expired, otherwise calls probe() to find it out and caches it"""
+    ttl = env.project.get('facts_ttl', FACTS_TTL)
+    facts = _load_facts()
+    fact = facts.get(_facts_key(), {}).get(name, None)
+    if fact and time.time() - fact['time'] < ttl:
+        return fact['value']
+    value = probe()
+    _set_fact(name, value)
+    return value
+
+def _set_fact(name, value):
+    """Stores fact in the cache"""
+    facts = _load_facts()
+    facts.setdefault(_facts_key(), {})[name] = {'value': value, 'time': time.time()}
+    _save_facts(facts)
+
+def _invalidate_facts(*names):
+    """Removes given facts (or all of them, if none given) for current host + virtualenv"""
+    facts = _load_facts()
+    host_facts = facts.get(_facts_key(), {})
+    for name in names or list(host_facts.keys()):
+        host_facts.pop(name, None)
+    _save_facts(facts)
+
+def clear_facts():
+    """Forgets cached facts (Python/Django versions, database, etc.) about the server"""
+    _require_environment()
+    _invalidate_facts()
 
-    # Shows conf file and optionally saves it
-    print(conf)
-    if console.confirm('Save to %s?' % output_file, default=False):
-        with open(output_file, 'w') as output:
-            output.write(conf)
+
+###############
+# State store #
+###############
+
+def _load_state():
+    """
+    Steps done at this host (see _pending_step), read from STATE_FILE once per session. Kept by user as well,
+    as STATE_FILE is at the user's home (and the user may change along the session, see adduser).
+    """
+    key = (env.user, env.host_string)
+    if key not in HOST_STATES:
+        with settings(hide('commands', 'warnings'), warn_only=True):
+            data = run('cat %s 2>/dev/null' % STATE_FILE)
+        try:
+            HOST_STATES[key] = json.loads(data) if data.succeeded else {}
+        except ValueError:
+            HOST_STATES[key] = {}
+    return HOST_STATES[key]
+
+def _save_state():
+    """Writes steps done at this host to STATE_FILE"""
+    with settings(hide('commands')):
+        run('mkdir -p %s && echo %s > %s' % (
+            REMOTE_HELPERS_DIR, shlex.quote(json.dumps(_load_state(), sort_keys=True)), STATE_FILE))
+
+def _fingerprint(inputs):
+    """Fingerprint of the inputs of a step"""
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _pending_step(step, probe, *inputs):
+    """
+    Should step be done at this host? Not if it was already recorded with the same inputs (see _record_step),
+    which needs no round trip. Otherwise, probe (a command that succeeds if the step is already done) decides,
+    and the step is recorded if it's done.
+    """
+    entry = _load_state().get(step, None)
+    if entry and entry['fingerprint'] == _fingerprint(inputs):
+        return False
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        done = run(probe).succeeded
+    if done:
+        _record_step(step, probe, *inputs)
+    return not done
+
+def _record_step(step, probe, *inputs):
+    """Records step as done at this host, with its inputs, and the probe that checks it (see verify_state)"""
+    _load_state()[step] = {'fingerprint': _fingerprint(inputs), 'probe': probe, 'time': time.time()}
+    _save_state()
+
+def verify_state():
+    """Re-checks, in a single round trip, that steps recorded at the server are still done, and forgets the ones that are not"""
+    _require_environment()
+    state = _load_state()
+    script = ['(%s) > /dev/null 2>&1 && echo ok %s || echo missing %s' % (entry['probe'], shlex.quote(step), shlex.quote(step))
+              for step, entry in sorted(state.items())]
+    if not script:
+        print('No steps recorded at %s' % env.host_string)
+        return
+    with settings(hide('commands', 'stdout')):
+        result = run('\n'.join(script))
+    missing = []
+    for line in result.splitlines():
+        status, step = line.strip().split(' ', 1)
+        print('    %-8s %s' % (status, step))
+        if status == 'missing':
+            missing.append(step)
+            state.pop(step, None)
+    if missing:
+        _save_state()
+    print('%d of %d recorded steps are still done at %s' % (len(script) - len(missing), len(script), env.host_string))
 
 
 ###########
@@ -170,7 +577,8 @@ def adduser(username, password):
     env.password = None
 
     # Creates user, if it doesn't exist already
-    if files.exists(env.remote_home):
+    step, probe = 'user:%(remote_user)s' % env, 'test -e %(remote_home)s' % env
+    if not _pending_step(step, probe, env.remote_home):
         print('User %(remote_user)s already exists on %(environment)s!' % env)
     else:
         sudo('useradd -d%(remote_home)s -s/bin/bash -m -U %(remote_user)s' % env)
@@ -181,49 +589,118 @@ def adduser(username, password):
         sudo('mkdir %(remote_home)s/.ssh' % env)
         put('~/.ssh/id_rsa.pub', '%(remote_home)s/.ssh/authorized_keys' % env, use_sudo=True, mode=0o644)
         sudo('chown -R %(remote_user)s:%(remote_user)s %(remote_home)s/.ssh' % env)
+        _record_step(step, probe, env.remote_home)
 
     # Continues as newly created user
     env.user = env.remote_user
     env.password = None
 
-def install_git():
-    """Installs (most recent) git from source"""
-    local_git_version = sudo(LOCAL_GIT_VERSION)
-    newest_git_version = run(NEWEST_GIT_VERSION)
-    if local_git_version != newest_git_version:
-        git_file = 'git-%s' % newest_git_version
+def install_git(version=None):
+    """
+    Installs (most recent, or given version) git from source. It's built once per OS/architecture,
+    and the binaries are kept locally (see ARTIFACTS_DIR) and installed at other servers as they are.
+    """
+    if not version:
+        version = _newest_git_version()
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        local_git_version = run(LOCAL_GIT_VERSION)
+    if local_git_version == version:
+        print('git %s already installed' % version)
+        return
+
+    with settings(hide('commands')):
+        name = 'git-%s-%s' % (version, run(OS_PLATFORM))
+    artifact = os.path.join(ARTIFACTS_DIR, '%s.tar.gz' % name)
+    remote_artifact = '%s/%s.tar.gz' % (REMOTE_HELPERS_DIR, name)
+    run('mkdir -p %s' % REMOTE_HELPERS_DIR)
+    if not os.path.exists(ARTIFACTS_DIR):
+        os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    packages_file = artifact[:-len('.tar.gz')] + '.packages'
+    with open(artifact + '.lock', 'w') as lock:
+        # Servers handled in parallel wait for the first one to build the artifact
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(artifact) and os.path.exists(packages_file):
+            put(artifact, remote_artifact)
+        else:
+            packages = _build_git(version, remote_artifact)
+            get(remote_artifact, artifact + '.part')
+            with open(packages_file, 'w') as output:
+                output.write('\n'.join(packages))
+            os.rename(artifact + '.part', artifact)
+    with open(packages_file, 'r') as input:
+        _install_runtime_packages(input.read().split())
+    # Directories that already exist (e.g.: /usr/local) keep their owner and mode
+    sudo('tar -xzf %s --no-overwrite-dir -C / && rm %s' % (remote_artifact, remote_artifact))
+
+def _newest_git_version():
+    """Most recent release of git, checked locally (so servers do not need network access)"""
+    with settings(hide('commands')):
+        tags = local(NEWEST_GIT_VERSION, capture=True).split()
+    versions = [tag[len('refs/tags/v'):] for tag in tags if re.match(r'^refs/tags/v\d+(\.\d+)*$', tag)]
+    return max(versions, key=lambda version: [int(number) for number in version.split('.')])
+
+def _build_git(version, remote_artifact):
+    """
+    Builds git from source, with parallel make, into remote_artifact (a .tar.gz of the installed files).
+    The source is downloaded locally and uploaded, so the server does not need network access.
+    Returns the packages that the binaries need at runtime.
+    """
+    source = os.path.join(ARTIFACTS_DIR, 'git-%s.tar.gz' % version)
+    if not os.path.exists(source):
+        local('curl -sfL -o %s.part %s && mv %s.part %s' % (source, GIT_SOURCE_URL % version, source, source))
+
+    build_dir = '%s/git-build' % REMOTE_HELPERS_DIR
+    apt_get_update()
+    sudo(APT_INSTALL % ' '.join(APT_PACKAGES['git']))
+    run('rm -rf %s && mkdir -p %s/stage' % (build_dir, build_dir))
+    put(source, '%s/git-%s.tar.gz' % (build_dir, version))
+    with cd(build_dir):
+        run('tar -xzf git-%s.tar.gz' % version)
+        with cd('git-%s' % version):
+            run('make --silent -j$(nproc) prefix=/usr/local all > /dev/null')
+            run('make --silent prefix=/usr/local DESTDIR=$(cd ../stage && pwd) install > /dev/null')
+        # Explicit paths (e.g.: usr), instead of '.', so that extracting at / doesn't touch /
+        run('tar -czf %s --owner=0 --group=0 -C stage $(ls -A stage)' % remote_artifact)
+        packages = _runtime_packages('stage')
+    run('rm -rf %s' % build_dir)
+    return packages
+
+def _runtime_packages(path):
+    """Debian packages of the shared libraries needed by binaries (executables, .so) under path, at the server"""
+    with settings(hide('commands')):
+        return run(RUNTIME_PACKAGES % path).split()
+
+def _install_runtime_packages(packages):
+    """Installs packages (see _runtime_packages) at the server, unless they are all there already"""
+    if not packages:
+        return
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        installed = run('dpkg -s %s > /dev/null 2>&1' % ' '.join(packages)).succeeded
+    if not installed:
         apt_get_update()
-        sudo('apt-get -y -qq install build-essential')
-        sudo('apt-get -y -qq install git-core')
-        sudo('apt-get -y -qq install libcurl4-gnutls-dev')
-        sudo('apt-get -y -qq install libexpat1-dev')
-        sudo('apt-get -y -qq install gettext')
-        sudo('apt-get -y -qq install libz-dev')
-        sudo('apt-get -y -qq install libssl-dev')
-        sudo('wget --quiet https://www.kernel.org/pub/software/scm/git/%s.tar.gz' % git_file)
-        sudo('tar -xzf %s.tar.gz' % git_file)
-        with cd(git_file):
-            sudo('make --silent prefix=/usr/local all > /dev/null')
-            sudo('make --silent prefix=/usr/local install  > /dev/null')
+        sudo(APT_INSTALL % ' '.join(packages))
 
 def apt_get_update():
     """Updates apt-get repositories, if needed"""
-    temp_dir = run('echo ${TMPDIR:-"/tmp/"}')
-    temp_file = os.path.join(temp_dir, 'apt-get-update-done')
+    _run_steps([_apt_get_update_step()], False)
+
+def _apt_get_update_step():
+    """Step (see _run_steps) that updates apt-get repositories, unless it was already done today"""
     today = datetime.date.today().strftime('%d/%m/%y')
-    if files.exists(temp_file):
-        last_date_run = run('cat %s' % temp_file)
-    else:
-        last_date_run = ''
-    if last_date_run != today:
-        sudo('apt-get update')
-        run('echo %s > %s' % (today, temp_file))
+    return ('[ "$(cat %s 2>/dev/null)" = %s ] || (%s && echo %s > %s)' % (
+        APT_UPDATE_DONE, today, _sudo_command('apt-get update'), today, APT_UPDATE_DONE), False, False)
 
 def hostname(name):
     """Updates server /etc/hosts and /etc/hostname"""
-    files.sed('/etc/hosts', '.*', '127.0.0.1 %s' % name, limit='^127.0.0.1 ', use_sudo=True)
-    sudo('mv /etc/hostname /etc/hostname.bak && echo %s > /etc/hostname' % name)
-    sudo('hostname %s' % name)
+    _run_steps(_hostname_steps(name), False)
+
+def _hostname_steps(name):
+    """Steps (see _run_steps) that update server /etc/hosts and /etc/hostname"""
+    return [
+        ("sed -i.bak -r -e '/^127.0.0.1 /s/.*/127.0.0.1 %s/g' /etc/hosts" % name, False, True),
+        ('mv /etc/hostname /etc/hostname.bak && echo %s > /etc/hostname' % name, False, True),
+        ('hostname %s' % name, False, True),
+    ]
 
 def check_cpu():
     """Check CPU usage"""
@@ -246,6 +723,66 @@ def check_io():
     with settings(warn_only=True):
         run('iostat')
 
+def sample_resources(interval=1, duration=None, top=5, output=None):
+    """
+    Samples CPU, memory, disk I/O, network and top processes on all hosts every interval seconds, until duration
+    (or Ctrl-C). Prints percentiles at the end, and optionally saves all samples to output (.csv or .json)
+    """
+    _require_environment()
+    all_hosts = env.get('all_hosts') or [env.host_string]
+    if env.host_string != all_hosts[0]:
+        return
+
+    # One SSH session (and reader thread) per host, each keeping the last SAMPLES_BUFFER samples
+    samples = dict([(host, collections.deque(maxlen=SAMPLES_BUFFER)) for host in all_hosts])
+    def read_samples(host, channel):
+        for line in channel.makefile('r'):
+            sample = json.loads(line)
+            samples[host].append(sample)
+            print('[%s] cpu %5.1f%% iowait %5.1f%% load %5.2f mem %6dMB disk r/w %6.2f/%6.2f MB/s net in/out %6.2f/%6.2f MB/s'
+                  ' | %s' % (host, sample['cpu'], sample['iowait'], sample['load'], sample['memory_mb'],
+                             sample['disk_read_mbs'], sample['disk_write_mbs'], sample['net_in_mbs'], sample['net_out_mbs'],
+                             ', '.join(['%(command)s %(cpu).0f%%' % process for process in sample['top']])))
+    for host in all_hosts:
+        with settings(host_string=host):
+            _upload_helper(sampler)
+            channel = _open_channel('python3 %s/sampler.py %s %s' % (REMOTE_HELPERS_DIR, float(interval), int(top)))
+        thread = threading.Thread(target=read_samples, args=(host, channel))
+        thread.daemon = True
+        thread.start()
+
+    try:
+        time.sleep(float(duration) if duration else 365 * 24 * 60 * 60)
+    except KeyboardInterrupt:
+        pass
+
+    # Summary
+    print('\n%-30s %-15s %8s %8s %8s %8s %8s' % ('host', 'metric', 'p50', 'p90', 'p99', 'max', 'samples'))
+    for host in all_hosts:
+        for metric in SAMPLES_METRICS:
+            values = sorted([sample[metric] for sample in samples[host]])
+            if values:
+                print('%-30s %-15s %8.2f %8.2f %8.2f %8.2f %8d' % (host, metric, _percentile(values, 50),
+                      _percentile(values, 90), _percentile(values, 99), values[-1], len(values)))
+
+    # Export
+    if output:
+        rows = [dict(sample, host=host) for host in all_hosts for sample in samples[host]]
+        with open(output, 'w') as file:
+            if output.endswith('.json'):
+                json.dump(rows, file, indent=1)
+            else:
+                writer = csv.writer(file)
+                writer.writerow(['host', 'time'] + SAMPLES_METRICS + ['top'])
+                for row in rows:
+                    writer.writerow([row['host'], row['time']] + [row[metric] for metric in SAMPLES_METRICS] +
+                                    [' '.join(['%(command)s:%(cpu)s' % process for process in row['top']])])
+        print('Samples saved to %s' % output)
+
+def _percentile(values, percent):
+    """Percentile (nearest rank) of sorted values"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
 
 ##################
 # MySQL commands #
@@ -255,95 +792,473 @@ def install_mysql():
     """Installs MySQL"""
     password = prompt('Password for MySQL root?', default='')
     apt_get_update()
-    sudo('DEBIAN_FRONTEND=noninteractive apt-get -y -qq install mysql-server libmysqlclient-dev')
+    sudo(APT_INSTALL % ' '.join(APT_PACKAGES['mysql']))
+    _run_steps(_mysql_password_steps(password), False)
+
+def _mysql_password_steps(password):
+    """Steps (see _run_steps) that set the password of MySQL root, without prompting for it (see _mysql_root_command)"""
+    return [
+        ('mysqladmin -u root password %s' % shlex.quote(password), True, True),
+        (_mysql_root_command("\"ALTER USER 'root'@'localhost' IDENTIFIED WITH mysql_native_password BY '%s';\"" % password,
+                             password), True, True),
+    ]
+
+def _mysql_root_command(statement, password=None):
+    """Command line of mysql as root: asks for the password, unless it's given (passed on in MYSQL_PWD)"""
+    if password is None:
+        return MYSQL_PREFIX % statement
+    return MYSQL_PWD_PREFIX % (shlex.quote(password), statement)
+
+def tune_mysql(restart=None):
+    """
+    Sizes MySQL for the server (memory, CPUs), the size of the database and the number of WSGI threads that
+    may connect to it. Shows the diff of the my.cnf fragment, installs it if confirmed, and restarts MySQL
+    (if confirmed, or restart=yes), rolling back the fragment if MySQL does not come back.
+    With ENVS 'mysql_host', tunes that server (once, as dedicated to MySQL) instead of the web hosts.
+    """
+    _require_environment()
+    mysql_host = env.project.get('mysql_host', None)
+    if mysql_host and env.host_string != mysql_host:
+        all_hosts = env.get('all_hosts') or [env.host_string]
+        if env.host_string == all_hosts[0]:
+            with settings(host_string=mysql_host):
+                tune_mysql(restart)
+        return
+    database = _get_database_name()
+    with settings(hide('commands')):
+        with shell_env(MYSQL_PWD=database['PASSWORD']):
+            version, data_mb = run('mysql -N -B %s -e "%s"' % (_mysql_args(database), MYSQL_SIZE_QUERY % database)).split()
+        current = run('cat %s 2>/dev/null || true' % MYSQL_TUNING_CNF)
+    conf = _mysql_tuning(_get_capacity(), version, int(data_mb), _planned_wsgi_threads())
+
+    if conf.strip() == current.strip():
+        print('%s is up to date' % MYSQL_TUNING_CNF)
+        return
+    sys.stdout.writelines(difflib.unified_diff(current.splitlines(True), conf.splitlines(True),
+                                               MYSQL_TUNING_CNF, '%s (tuned)' % MYSQL_TUNING_CNF))
+    if not console.confirm('Install %s?' % MYSQL_TUNING_CNF, default=False):
+        return
+    sudo('[ ! -e %s ] || cp -p %s %s.bak' % (MYSQL_TUNING_CNF, MYSQL_TUNING_CNF, MYSQL_TUNING_CNF))
+    put(io.StringIO(conf), MYSQL_TUNING_CNF, use_sudo=True, mode=0o644)
+
+    if restart is None:
+        restart = console.confirm('Restart MySQL now?', default=False)
+    if not _is_true(restart):
+        print('New settings take effect at the next restart of MySQL')
+        return
     with settings(warn_only=True):
-        sudo('mysqladmin -u root password %s' % password)
-        sudo(MYSQL_PREFIX % "\"ALTER USER 'root'@'localhost' IDENTIFIED WITH mysql_native_password BY '%s';\"" % password)
+        restarted = sudo('service mysql restart').succeeded and run('mysqladmin -u root ping').succeeded
+    if not restarted:
+        sudo('if [ -e %s.bak ]; then mv %s.bak %s; else rm %s; fi' % ((MYSQL_TUNING_CNF,) * 4))
+        sudo('service mysql restart')
+        abort('MySQL did not restart with the new settings: previous ones were restored')
+
+def _planned_wsgi_threads():
+    """
+    WSGI threads of all web hosts of the environment, which may connect at once to MySQL: processes x threads of
+    each host, as sized for its Apache conf (see _wsgi_sizing, ENVS 'wsgi_*' entries and the facts cache)
+    """
+    threads = 0
+    for host in _web_hosts(env.project):
+        with settings(host_string=host):
+            sizing = _wsgi_sizing(_get_capacity())
+        threads += sizing['wsgi_processes'] * sizing['wsgi_threads']
+    return threads
+
+def _web_hosts(project):
+    """All hosts of an environment, as in Fabric's host list (see _setup_environment), except MySQL's own server"""
+    if project.get('hosts', None):
+        hosts = list(project['hosts'])
+    elif project.get('roles', None):
+        hosts = [host for role in project['roles'].values() for host in role]
+    else:
+        hosts = [project['host']]
+    return [host for host in hosts if host != project.get('mysql_host', None)]
+
+def _mysql_tuning(capacity, version, data_mb, wsgi_threads):
+    """
+    my.cnf fragment for the server's capacity, MySQL (or MariaDB) version, database size and WSGI threads that may
+    connect. Any setting can be overridden by ENVS: mysql_buffer_pool_mb, mysql_max_connections,
+    mysql_flush_log_at_trx_commit.
+    """
+    # A server of its own (ENVS 'mysql_host') does not have to leave memory for WSGI processes
+    dedicated = env.host_string == env.project.get('mysql_host', None)
+    available_mb = capacity['memory_mb'] * (1 if dedicated else 1 - WSGI_MEMORY_SHARE) * MYSQL_MEMORY_SHARE
+    buffer_pool_mb = int(env.project.get('mysql_buffer_pool_mb', None) or
+                         max(128, min(available_mb, data_mb * MYSQL_DATA_GROWTH)) // 128 * 128)
+    max_connections = int(env.project.get('mysql_max_connections', None) or max(100, int(wsgi_threads * 1.2) + 10))
+    flush_log = int(env.project.get('mysql_flush_log_at_trx_commit', 1))
+
+    # Redo log: about a quarter of the buffer pool. MariaDB (its versions are 10.x, 11.x) has a single redo log file
+    # since 10.5, and has no buffer pool instances since 10.6
+    redo_log_mb = max(96, min(4096, buffer_pool_mb // 4))
+    major, minor, patch = [int(number) for number in re.findall(r'\d+', version)[:3]]
+    engine_settings = []
+    if 'mariadb' in version.lower():
+        single_log = (major, minor) >= (10, 5)
+        engine_settings.append('innodb_log_file_size           = %dM' % (redo_log_mb if single_log else redo_log_mb // 2))
+        if (major, minor) < (10, 6):
+            engine_settings.append('innodb_buffer_pool_instances   = %d' % max(1, min(8, buffer_pool_mb // 1024)))
+    else:
+        engine_settings.append('innodb_buffer_pool_instances   = %d' % max(1, min(8, buffer_pool_mb // 1024)))
+        if (major, minor, patch) >= (8, 0, 30):
+            engine_settings.append('innodb_redo_log_capacity       = %dM' % redo_log_mb)
+        else:
+            engine_settings.append('innodb_log_file_size           = %dM' % (redo_log_mb // 2))
+
+    print('MySQL tuning for %d CPUs, %dMB RAM%s, %dMB of data, %d WSGI threads: %dMB buffer pool, %d connections' % (
+        capacity['cpus'], capacity['memory_mb'], ' (dedicated)' if dedicated else '', data_mb, wsgi_threads,
+        buffer_pool_mb, max_connections))
+    return '\n'.join([
+        '# Generated by fabmanager (tune_mysql) for %s' % env.environment,
+        '[mysqld]',
+        'innodb_buffer_pool_size        = %dM' % buffer_pool_mb,
+    ] + engine_settings + [
+        'innodb_flush_log_at_trx_commit = %d' % flush_log,
+        'innodb_flush_method            = O_DIRECT',
+        'innodb_read_io_threads         = %d' % max(4, capacity['cpus']),
+        'innodb_write_io_threads        = %d' % max(4, capacity['cpus']),
+        'max_connections                = %d' % max_connections,
+        'thread_cache_size              = %d' % min(100, max_connections // 4),
+        'table_open_cache               = %d' % max(2000, max_connections * 4),
+        '',
+    ])
 
 def _get_database_name():
     """Gets database dictionary either from ENVS or form Django settings.py"""
     _require_environment()
     database = env.project.get('database', None)
     if not database:
-        django.settings_module(_interpolate('%(project)s.%(settings)s'))
-        database = django_settings.DATABASES['default']
+        database = _get_fact('database', _load_database_settings)
     return database
 
-def _database_exists():
-    """Checks for existence of database"""
+def _load_database_settings():
+    """Loads database dictionary from Django settings.py"""
+    django.settings_module(_interpolate('%(project)s.%(settings)s'))
+    return dict(django_settings.DATABASES['default'])
+
+def _database_exists(password=None):
+    """Checks for existence of database (password of MySQL root is asked, unless given)"""
     _require_environment()
     database = _get_database_name()
+    if _get_fact('database_exists', lambda: _probe_database(password)):
+        return True
+    else:
+        print('Database %(NAME)s does not exist' % database)
+        return False
+
+def _probe_database(password=None):
+    """Checks at the server for existence of database"""
+    database = _get_database_name()
     with settings(hide('warnings'), warn_only=True):
-        result = run(MYSQL_PREFIX % "\"SHOW DATABASES LIKE '%(NAME)s';\"" % database)
-        if database['NAME'] in result:
-            return True
-        else:
-            print('Database %(NAME)s does not exist' % database)
-            return False
+        result = run(_mysql_root_command("\"SHOW DATABASES LIKE '%(NAME)s';\"" % database, password))
+        return database['NAME'] in result
 
-def drop_database():
+def drop_database(password=None):
     """CAREFUL! - Destroys (DROP) MySQL database according to env's settings.py"""
     _require_environment()
     database = _get_database_name()
-    if _database_exists():
+    if _database_exists(password):
         if console.confirm('ATTENTION! This will destroy current database! Confirm?', default=False):
             with settings(hide('warnings'), warn_only=True):
-                result = run(MYSQL_PREFIX % "\"DROP DATABASE %(NAME)s;\"" % database)
+                result = run(_mysql_root_command("\"DROP DATABASE %(NAME)s;\"" % database, password))
+                _invalidate_facts('database_exists')
 
-def create_database():
+def create_database(password=None):
     """Creates MySQL database according to env's settings.py, if not already there"""
     database = _get_database_name()
     with settings(hide('warnings'), warn_only=True):
-        result = run(MYSQL_PREFIX % "\"CREATE DATABASE %(NAME)s DEFAULT CHARACTER SET utf8;\"" % database)
+        result = run(_mysql_root_command("\"CREATE DATABASE %(NAME)s DEFAULT CHARACTER SET utf8;\"" % database, password))
+        _invalidate_facts('database_exists')
         if result.succeeded:
-            run(MYSQL_PREFIX % "\"CREATE USER '%(USER)s'@'localhost' IDENTIFIED BY '%(PASSWORD)s';\"" % database)
-            run(MYSQL_PREFIX % "\"GRANT ALL ON %(NAME)s.* TO '%(USER)s'@'localhost';\"" % database)
+            run(_mysql_root_command("\"CREATE USER '%(USER)s'@'localhost' IDENTIFIED BY '%(PASSWORD)s';\"" % database, password))
+            run(_mysql_root_command("\"GRANT ALL ON %(NAME)s.* TO '%(USER)s'@'localhost';\"" % database, password))
             # run(MYSQL_PREFIX % "\"ALTER USER '%(USER)s'@'localhost' IDENTIFIED WITH mysql_native_password BY '%(PASSWORD)s';\"" % database)
 
-def backup_database():
+def _mysqldump_command(database):
+    """mysqldump command for the whole database"""
+    return MYSQLDUMP_COMMAND % dict(database, host='-h %s' % database['HOST'] if database.get('HOST', None) else '')
+
+def _mysql_args(database):
+    """Connection arguments for mysql/mysqldump, except password (see shell_env MYSQL_PWD)"""
+    return '%s -u %s' % ('-h %s' % database['HOST'] if database.get('HOST', None) else '', database['USER'])
+
+def _list_tables(database):
+    """List of (name, type, estimated rows, data size) of all tables in the database, largest first"""
+    with settings(hide('commands')):
+        with shell_env(MYSQL_PWD=database['PASSWORD']):
+            result = run('mysql -N -B %s -e "%s"' % (_mysql_args(database), MYSQL_TABLES_QUERY % database))
+    tables = []
+    for line in result.splitlines():
+        name, type, rows, size = line.strip().split('\t')
+        tables.append((name, type, int(rows) if rows.isdigit() else 0, int(size) if size.isdigit() else 0))
+    return sorted(tables, key=lambda table: -table[3])
+
+def _per_table_dump_steps(database, path, workers):
     """
-    Backup server's database and copy tar.gz to local ../backup dir
+    Steps to dump each table into its own gzipped file under path/tables, plus a path/manifest.tsv
+    with table name, type, rows, sha256 and file of each dump.
+
+    Tables are distributed (largest first) among workers, each one a single mysqldump --single-transaction
+    of its share of tables. A control session holds a read lock (see _snapshot_lock) while workers start,
+    and releases it once all of them have their transaction: their snapshots are thus the same. So is the
+    one of a counting session, started under the lock as well, which counts the rows of each table.
+    """
+    tables = _list_tables(database)
+    base_tables = [table for table in tables if table[1] == 'BASE TABLE']
+    views = [table for table in tables if table[1] != 'BASE TABLE']
+    workers = max(1, min(int(workers), len(base_tables)))
+    shares = [[] for worker in range(workers)] if base_tables else []
+    for index, table in enumerate(base_tables):
+        shares[index % workers].append(table[0])
+
+    dump = 'mysqldump --single-transaction --no-tablespaces %s' % _mysql_args(database)
+    script = ['set -o pipefail', 'mkdir -p %s/tables' % path]
+    if shares:
+        script.extend([
+            'trap "touch %s/unlock" EXIT' % path,
+            "(echo '%s;'; echo \"SELECT 'locked';\"; while [ ! -e %s/unlock ]; do sleep 0.1; done; echo 'UNLOCK TABLES;') "
+            "| mysql -N -B --unbuffered %s > %s/lock.log & lock=$!" % (
+                _snapshot_lock(database, base_tables), path, _mysql_args(database), path),
+            'until grep -qs locked %s/lock.log; do kill -0 $lock 2>/dev/null || exit 1; sleep 0.1; done' % path,
+            'pids=""',
+        ])
+        for index, share in enumerate(shares):
+            script.append('(%s -v %s %s 2> %s/dump-%d.log | %s) & pids="$pids $!"; pid%d=$!' % (
+                dump, database['NAME'], ' '.join(share), path, index, SPLIT_DUMP_SCRIPT % ('%s/tables' % path), index))
+        script.append("(echo 'SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ; START TRANSACTION WITH CONSISTENT "
+                      "SNAPSHOT;'; echo \"SELECT 'started';\"; %s) | mysql -N -B --unbuffered %s %s > %s/counts.tsv & "
+                      "count=$!; pids=\"$pids $count\"" % (
+                          '; '.join(["echo 'SELECT COUNT(*) FROM `%s`;'" % table[0] for table in base_tables]),
+                          _mysql_args(database), database['NAME'], path))
+        for index, share in enumerate(shares):
+            script.append("until grep -qs '%s' %s/dump-%d.log || ! kill -0 $pid%d 2>/dev/null; do sleep 0.1; done" % (
+                DUMP_STARTED_LOG, path, index, index))
+        script.append('until grep -qs started %s/counts.tsv || ! kill -0 $count 2>/dev/null; do sleep 0.1; done' % path)
+        script.extend([
+            'touch %s/unlock && trap - EXIT && wait $lock' % path,
+            'rc=0; for pid in $pids; do wait $pid || rc=1; done',
+            '[ $rc -eq 0 ] || { grep -v -h "^-- " %s/dump-*.log >&2; exit 1; }' % path,
+            'rm -f %s/unlock %s/lock.log %s/dump-*.log' % (path, path, path),
+        ])
+    if views:
+        script.append('%s --no-data --skip-triggers %s %s | gzip --rsyncable -c > %s/%s' % (
+            dump, database['NAME'], ' '.join([view[0] for view in views]), path, VIEWS_DUMP_FILE))
+
+    # Manifest
+    steps = [('export MYSQL_PWD=\'%s\' && (\n%s\n)' % (database['PASSWORD'], '\n'.join(script)), False, False)]
+    # (rows of table N are in line N+1 of counts.tsv, after 'started')
+    entries = [(name, type, '$(sed -n %dp counts.tsv)' % (index + 2), 'tables/%s.sql.gz' % name)
+               for index, (name, type, rows, size) in enumerate(base_tables)]
+    if views:
+        entries.append(('.views', 'VIEW', 0, VIEWS_DUMP_FILE))
+    manifest = ["echo '%s'" % MANIFEST_HEADER]
+    for name, type, rows, file in entries:
+        manifest.append('echo "%s\t%s\t%s\t$(sha256sum %s | cut -d\' \' -f1)\t%s"' % (name, type, rows, file, file))
+    steps.append(('cd %s && (%s) > manifest.tsv && rm -f counts.tsv' % (path, ' && '.join(manifest)), False, False))
+    return steps
+
+def _snapshot_lock(database, base_tables):
+    """
+    Statement that stops writes while per table dumps start: a global read lock, if the user has the RELOAD
+    privilege, or else a read lock on all tables of the database (enough, as only they are dumped)
+    """
+    with settings(hide('commands')):
+        with shell_env(MYSQL_PWD=database['PASSWORD']):
+            grants = run('mysql -N -B %s -e "SHOW GRANTS"' % _mysql_args(database))
+    if re.search(r'GRANT (ALL PRIVILEGES|.*\bRELOAD\b).* ON \*\.\* ', grants):
+        return 'FLUSH TABLES WITH READ LOCK'
+    return 'LOCK TABLES %s' % ', '.join(['`%s` READ' % table[0] for table in base_tables])
+
+def _free_backup_path(dirname):
+    """Finds a path for a new backup dir, avoiding existing similar names, in one round trip"""
+    with hide('commands'):
+        return run('path=%s; index=0; '
+                   'while [ -e $path ] || [ -e $path.tar.gz ] || [ -e $path.tar ]; do index=$((index+1)); path=%s.$index; done; '
+                   'echo $path' % (dirname, dirname))
+
+def backup_database(batch=None, workers=None):
+    """
+    Backup server's database and copy tar.gz to local ../backup dir. Use batch=yes for a single round trip,
+    workers=N to dump tables in parallel (one .sql.gz per table, in a .tar)
     """
     _require_environment()
     database = _get_database_name()
+    workers = workers or env.project.get('backup_workers', None)
     with prefix(_django_prefix()):
         with cd(_django_project_dir()):
             # Creates dir to store backup, avoiding existing similar names
             dirname = '../backup/%s_%s' % (datetime.date.today().strftime('%Y%m%d'), env.environment)
-            path = dirname
-            index = 0
-            while files.exists(path) or files.exists('%s.tar.gz' % path):
-                index += 1
-                path = '%s.%s' % (dirname, index)
-            run('mkdir -p %s' % path)
-
-            # Backup MySQL
-            run("mysqldump --no-tablespaces %s -u %s -p'%s' %s --no-tablespaces > %s/%s.sql" % (
-                '-h %s' % database['HOST'] if database.get('HOST', None) else '',
-                database['USER'],
-                database['PASSWORD'],
-                database['NAME'],
-                path,
-                env.project['project'],
-            ))
-
-            # Backup extra files
-            extra_backup_files = env.project.get('extra_backup_files', [])
+            path = _free_backup_path(dirname)
+            steps = [('mkdir -p %s' % path, False, False)]
+
+            # Backup MySQL, either per table or the whole database at once
+            if workers:
+                steps.extend(_per_table_dump_steps(database, path, workers))
+                archive, tar = '%s.tar' % path, 'tar -cf %(archive)s %(path)s/'
+            else:
+                steps.append(('%s > %s/%s.sql' % (_mysqldump_command(database), path, env.project['project']), False, False))
+                archive, tar = '%s.tar.gz' % path, 'set -o pipefail && tar -c %(path)s/ | gzip --rsyncable > %(archive)s'
+
+            # Backup extra files (unless they go to the incremental store, see backup_files)
+            incremental = env.project.get('incremental_backup_files', False)
+            extra_backup_files = [] if incremental else env.project.get('extra_backup_files', [])
             for file in extra_backup_files:
-                run('cp -R %s %s/' % (file, path))
+                steps.append(('cp -R %s %s/' % (file, path), False, False))
+
+            # Create .tar(.gz) and removes uncompressed files (gzip --rsyncable helps delta transfers, see _download)
+            steps.append((tar % {'archive': archive, 'path': path}, False, False))
+            steps.append(('rm -rf %s/' % path, False, False))
 
-            # Create .tar.gz and removes uncompressed files
-            with hide('stdout'):
-                run('tar -czvf %s.tar.gz %s/' % (path, path))
-            run('rm -rf %s/' % path)
+            _run_steps(steps, _batch_mode(batch))
+            if incremental and env.project.get('extra_backup_files', []):
+                backup_files(os.path.basename(path))
 
             # Download backup?
             if console.confirm('Download backup?'):
-                return get('%s.tar.gz' % path, '../backup')
+                return _download(archive, '../backup')
 
-def restore_database(filename):
+def stream_backup_database(compressor='zstd', level=None):
+    """
+    Backup server's database (and extra files) streaming it compressed directly to local ../backup dir
+    """
+    _require_environment()
+    database = _get_database_name()
+    command, default_level, extension = COMPRESSORS[compressor]
+    compress = command % {'level': level or default_level}
+
+    # Creates local dir to store backup, avoiding existing similar names
+    dirname = '../backup/%s_%s' % (datetime.date.today().strftime('%Y%m%d'), env.environment)
+    path = dirname
+    index = 0
+    while os.path.exists(path) or os.path.exists('%s.tar.gz' % path):
+        index += 1
+        path = '%s.%s' % (dirname, index)
+    os.makedirs(path)
+
+    # Backup MySQL
+    streams = [('%s.sql.%s' % (env.project['project'], extension), _mysqldump_command(database))]
+
+    # Backup extra files
+    extra_backup_files = env.project.get('extra_backup_files', [])
+    if extra_backup_files:
+        streams.append(('files.tar.%s' % extension, 'cd %s && tar -cf - %s' % (
+            _django_project_dir(), ' '.join(extra_backup_files))))
+
+    for filename, command in streams:
+        local_file = os.path.join(path, filename)
+        print('[%s] streaming: %s > %s' % (env.host_string, command.split(' ')[0], local_file))
+        start = time.time()
+        size, raw_size = _stream_command(command, compress, local_file)
+        elapsed = max(time.time() - start, 0.001)
+        print('    %.1f MB (%.1f MB uncompressed) in %.1fs: %.1f MB/s, compression ratio %.2f' % (
+            size / 1e6, raw_size / 1e6, elapsed, raw_size / 1e6 / elapsed, raw_size / float(size or 1)))
+    return path
+
+def _stream_command(command, compress, local_file):
+    """
+    Runs command at the server, piped through compress, writing the output directly to local_file.
+    Nothing is stored at the server. Returns sizes (compressed, uncompressed) of the stream.
     """
-    Restore server's database with .sql file contained in filename
+    script = 'set -o pipefail; %s | tee >(wc -c | sed "s/^/%s /" >&2) | %s' % (command, STREAM_BYTES_MARKER, compress)
+    channel = _open_channel(script)
+
+    size = 0
+    with open(local_file, 'wb') as output:
+        while True:
+            data = channel.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            output.write(data)
+            size += len(data)
+    status = channel.recv_exit_status()
+    stderr = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+    channel.close()
+
+    raw_size = 0
+    for line in stderr.splitlines():
+        if line.startswith(STREAM_BYTES_MARKER):
+            raw_size = int(line.split()[1])
+        elif line.strip() and 'password on the command line' not in line:
+            print(line)
+    if status != 0:
+        abort('Streaming failed (exit code %d): %s' % (status, command.split(' ')[0]))
+    return size, raw_size
+
+def _delta_transfer():
+    """Should backups be transferred with rsync (only differences against previous ones)? Depends on ENVS 'delta_transfer'"""
+    return env.project.get('delta_transfer', False)
+
+def _rsync(source, destination):
+    """
+    Transfers a file with rsync, using as basis the most similar file already at the destination dir (--fuzzy),
+    so only differences are sent. Interrupted transfers are kept (--partial-dir) and resumed, up to RSYNC_RETRIES.
+    """
+    ssh = 'ssh -p %s' % (env.port or 22)
+    for key_filename in ([env.key_filename] if isinstance(env.key_filename, str) else env.key_filename or []):
+        ssh += ' -i %s' % key_filename
+    command = 'rsync --fuzzy --partial-dir=.rsync-partial --timeout=60 --stats -e "%s" %s %s' % (ssh, source, destination)
+    for attempt in range(RSYNC_RETRIES):
+        with settings(warn_only=True):
+            result = local(command, capture=True)
+        if result.succeeded or result.return_code not in RSYNC_RETRY_CODES:
+            break
+        print('rsync interrupted (exit code %d), resuming...' % result.return_code)
+    if result.failed:
+        abort('rsync failed: %s' % result.stderr)
+
+    # Reports actual traffic versus size of the file
+    stats = {}
+    for line in result.splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)
+            stats[key.strip()] = value.strip().split(' ')[0].replace(',', '')
+    size = int(stats.get('Total file size', 0))
+    transferred = int(stats.get('Total bytes sent', 0)) + int(stats.get('Total bytes received', 0))
+    print('%s: %.1f MB, transferred %.1f MB (%.0f%%)' % (
+        os.path.basename(source), size / 1e6, transferred / 1e6, 100.0 * transferred / (size or 1)))
+
+def _remote_path(path):
+    """user@host:path, for rsync, with path relative to project's dir"""
+    if not path.startswith('/'):
+        path = '%s/%s' % (_django_project_dir(), path)
+    return '%s@%s:%s' % (env.user, env.host, path)
+
+def _download(remote_path, local_dir):
+    """Downloads a (backup) file, either with get() or with rsync, see _delta_transfer"""
+    if not _delta_transfer():
+        return get(remote_path, local_dir)
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    _rsync(_remote_path(remote_path), '%s/' % local_dir)
+    return [os.path.join(local_dir, os.path.basename(remote_path))]
+
+def _upload(local_path, remote_path):
+    """Uploads a (backup) file, either with put() or with rsync, see _delta_transfer"""
+    if not _delta_transfer():
+        return put(local_path, remote_path)
+    _rsync(local_path, _remote_path(remote_path))
+
+def _open_channel(script):
+    """Runs script at the server (with bash) on a raw SSH channel, for binary input/output"""
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command('bash -c %s' % shlex.quote(script))
+    return channel
+
+def _recv_exactly(channel, size):
+    """Reads exactly size bytes from channel"""
+    data = []
+    while size > 0:
+        chunk = channel.recv(min(size, STREAM_CHUNK_SIZE))
+        if not chunk:
+            abort('Connection closed while receiving data')
+        data.append(chunk)
+        size -= len(chunk)
+    return b''.join(data)
+
+def restore_database(filename, workers=None, tune='yes'):
+    """
+    Restore server's database with the backup in filename (.tar.gz or per table .tar, see backup_database)
     """
     _require_environment()
     database = _get_database_name()
@@ -351,34 +1266,197 @@ def restore_database(filename):
         with cd(_django_project_dir()):
             # Uploads tar file
             tarfile = os.path.basename(filename)
-            basename = tarfile[:tarfile.index('.tar.gz')]
+            basename = tarfile[:tarfile.index('.tar')]
+            extract = 'tar -xzf' if tarfile.endswith('.tar.gz') else 'tar -xf'
             if console.confirm('Upload backup?'):
-                put(filename, '../backup/%s' % tarfile)
+                _upload(filename, '../backup/%s' % tarfile)
 
-            # Drop and recreate current database
-            drop_database()
-            create_database()
+            # Drop and recreate current database, and restore MySQL, streaming straight from the tar file
+            # To avoid silly mistakes, instead of using project's user & password, uses root's (asked once)
+            password = getpass.getpass('Password for MySQL root? ')
+            drop_database(password)
+            create_database(password)
 
-            # Restore MySQL
-            # To avoid silly mistakes, instead of using project's user & password, uses root's
             with cd('../'):
-                run('tar -xzvf backup/%s' % tarfile)
-                run('mysql -u root -p %s < backup/%s/%s.sql' % (
-                    #database['USER'],
-                    #database['PASSWORD'],
-                    database['NAME'],
-                    basename,
-                    env.project['project'],
-                ))
+                with shell_env(MYSQL_PWD=password):
+                    flush_log = _relax_flush_log() if _is_true(tune) else None
+                    try:
+                        if tarfile.endswith('.tar.gz'):
+                            loads, views = [('database', 'backup/%s/%s.sql' % (basename, env.project['project']), 'cat')], []
+                        else:
+                            loads, views = _table_loads(tarfile, basename)
+                        _load_tables(database, tarfile, extract, loads, views,
+                                     workers or env.project.get('backup_workers', RESTORE_WORKERS), _is_true(tune))
+                    finally:
+                        if flush_log is not None:
+                            run('mysql -u root -e "SET GLOBAL %s=%s;"' % (RESTORE_FLUSH_LOG, flush_log))
+
+                # Extracts only the extra files from the tar file (unless they are in the incremental store)
+                incremental = env.project.get('incremental_backup_files', False)
+                extra_backup_files = [] if incremental else env.project.get('extra_backup_files', [])
+                if extra_backup_files:
+                    run('%s backup/%s %s' % (extract, tarfile, ' '.join(
+                        ['backup/%s/%s' % (basename, os.path.basename(file)) for file in extra_backup_files])))
 
             # Restore extra files
-            extra_backup_files = env.project.get('extra_backup_files', [])
             for file in extra_backup_files:
                 run('cp -R ../backup/%s/%s ./%s' % (basename, os.path.basename(file), os.path.dirname(file)))
 
-            # Removes uncompressed files, but leaves .tar.gz
+            if incremental and env.project.get('extra_backup_files', []):
+                restore_files(basename)
+
+            # Removes uncompressed files, but leaves .tar(.gz)
             run('rm -rf ../backup/%s' % basename)
 
+def _relax_flush_log():
+    """Flushes redo log once per second, instead of at each commit, during a restore. Returns previous value"""
+    with settings(hide('commands')):
+        flush_log = run('mysql -N -B -u root -e "SELECT @@GLOBAL.%s;"' % RESTORE_FLUSH_LOG)
+    run('mysql -u root -e "SET GLOBAL %s=2;"' % RESTORE_FLUSH_LOG)
+    return flush_log.strip()
+
+def _table_loads(tarfile, basename):
+    """Lists of (table, file inside tarfile, decompressor) of tables and of views, from the manifest of a per table backup"""
+    with settings(hide('commands')):
+        manifest = run('tar -xOf backup/%s backup/%s/manifest.tsv' % (tarfile, basename))
+    tables, views = [], []
+    for line in manifest.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        name, type, rows, checksum, file = line.strip().split('\t')
+        load = (name, 'backup/%s/%s' % (basename, file), 'zcat')
+        (tables if type == 'BASE TABLE' else views).append(load)
+    return tables, views
+
+def _load_tables(database, tarfile, extract, loads, views, workers, tune):
+    """
+    Streams each (table, file, decompressor) in loads from tarfile into mysql, with up to workers
+    loads at the same time, then the ones in views (after all tables), and prints time spent on each table.
+    A table fails if tar, the decompressor or mysql fails (pipefail is set in each load, as xargs' shells
+    don't inherit it).
+    """
+    session_sql = RESTORE_SESSION_SQL if tune else ''
+    script = [
+        'load() { set -o pipefail; start=$(date +%%s%%N); '
+        '(echo "%s"; %s backup/%s "$2" | $3) | mysql -u root %s; rc=$?; '
+        'echo "%s $1 $rc $(( ($(date +%%s%%N) - start) / 1000000 ))"; return $rc; }' % (
+            session_sql, extract.replace('-x', '-xO'), tarfile, database['NAME'], RESTORE_TIME_MARKER),
+        'export -f load',
+    ]
+    for group, parallelism in ((loads, workers), (views, 1)):
+        if group:
+            script.append("printf '%%s\\n' %s | xargs -P %s -L 1 bash -c 'load $0 $1 $2'" % (
+                ' '.join(["'%s %s %s'" % load for load in group]), parallelism))
+
+    with settings(hide('stdout'), warn_only=True):
+        result = run('set -o pipefail; %s' % '; '.join(script))
+
+    timings = []
+    for line in result.splitlines():
+        words = line.strip().split(' ')
+        if words[0] == RESTORE_TIME_MARKER:
+            timings.append((int(words[3]), words[1], int(words[2])))
+        elif line.strip():
+            print(line)
+    print('\nRestore time by table:')
+    for elapsed, table, return_code in sorted(timings, reverse=True):
+        print('    %-40s %8.1fs %s' % (table, elapsed / 1000.0, 'ok' if return_code == 0 else 'FAILED'))
+    if result.failed or any(return_code for elapsed, table, return_code in timings):
+        abort('Restore failed')
+
+def _upload_helper(module):
+    """Uploads one of fabmanager's helper scripts (e.g.: chunkstore.py) to the server"""
+    run('mkdir -p %s' % REMOTE_HELPERS_DIR)
+    with hide('running'):
+        put(module.__file__, '%s/%s' % (REMOTE_HELPERS_DIR, os.path.basename(module.__file__)))
+
+def _chunkstore(command, filename):
+    """Command line to invoke chunkstore.py at the server (see _upload_helper), at project's dir level"""
+    return 'cd %s && python3 %s/chunkstore.py %s %s' % (_django_project_dir(), REMOTE_HELPERS_DIR, command, filename)
+
+def _scan_backup_files():
+    """Manifest of all extra_backup_files at the server (see chunkstore.py)"""
+    extra_backup_files = env.project.get('extra_backup_files', [])
+    if not extra_backup_files:
+        abort('There are no extra_backup_files for %(environment)s' % env)
+    with settings(hide('stdout')):
+        return json.loads(run('%s %s' % (
+            _chunkstore('scan', _interpolate(CHUNKSTORE_CACHE)), ' '.join(extra_backup_files)), pty=False))
+
+def backup_files(name=None):
+    """Incremental backup of extra_backup_files into local ../backup/store, transferring only new content"""
+    _require_environment()
+    name = name or '%s_%s' % (datetime.date.today().strftime('%Y%m%d'), env.environment)
+    _upload_helper(chunkstore)
+    manifest = _scan_backup_files()
+    missing = chunkstore.missing_chunks(BACKUP_STORE_DIR, manifest)
+
+    # Downloads new chunks only
+    start = time.time()
+    if missing:
+        channel = _open_channel(_chunkstore('pack', _interpolate(CHUNKSTORE_CACHE)))
+        channel.sendall(''.join(['%s\n' % chunk for chunk, size in missing]).encode('ascii'))
+        channel.shutdown_write()
+        owners = dict([(chunk, path) for path, info in manifest['files'].items() for chunk in info['chunks']])
+        for chunk, size in missing:
+            try:
+                chunkstore.store_chunk(BACKUP_STORE_DIR, chunk, _recv_exactly(channel, size))
+            except ValueError:
+                abort('Corrupted content received for %s (chunk %s), snapshot not saved' % (owners[chunk], chunk))
+        if channel.recv_exit_status() != 0:
+            abort('Could not read files at the server')
+        channel.close()
+    chunkstore.save_snapshot(BACKUP_STORE_DIR, name, manifest)
+
+    total_size = sum([info['size'] for info in manifest['files'].values()])
+    new_size = sum([size for chunk, size in missing])
+    print('Snapshot %s: %d files, %.1f MB, of which %.1f MB new (%d chunks) transferred in %.1fs' % (
+        name, len(manifest['files']), total_size / 1e6, new_size / 1e6, len(missing), time.time() - start))
+    return name
+
+def restore_files(snapshot=None, delete=None):
+    """Restores extra_backup_files at the server from a snapshot in local ../backup/store (lists them, if none given), deleting files not in it on confirmation (or delete=yes)"""
+    _require_environment()
+    if not snapshot:
+        print('\n'.join(chunkstore.list_snapshots(BACKUP_STORE_DIR)))
+        return
+    manifest = chunkstore.load_snapshot(BACKUP_STORE_DIR, snapshot)
+    if manifest is None:
+        abort('There is no snapshot %s in %s' % (snapshot, BACKUP_STORE_DIR))
+    # Only files that differ from current ones are sent
+    _upload_helper(chunkstore)
+    current = _scan_backup_files()['files']
+    changed = dict([(path, info) for path, info in manifest['files'].items()
+                    if current.get(path, {}).get('chunks', None) != info['chunks']])
+    changed = {'chunk_size': manifest['chunk_size'], 'files': changed}
+    try:
+        chunkstore.check_chunks(BACKUP_STORE_DIR, changed)
+    except ValueError as e:
+        abort('Cannot restore snapshot %s: %s' % (snapshot, e))
+    manifest_file = '%s/restore-%s.json' % (REMOTE_HELPERS_DIR, env.environment)
+    put(io.BytesIO(json.dumps(changed).encode('utf-8')), manifest_file)
+    channel = _open_channel(_chunkstore('unpack', manifest_file))
+    try:
+        for data in chunkstore.read_chunks(BACKUP_STORE_DIR, changed):
+            channel.sendall(data)
+    except ValueError as e:
+        channel.close()
+        abort('Could not restore files at the server: %s' % e)
+    channel.shutdown_write()
+    if channel.recv_exit_status() != 0:
+        abort('Could not restore files at the server: %s' % channel.makefile_stderr('rb').read().decode('utf-8', 'replace'))
+    channel.close()
+    print('Snapshot %s: %d of %d files restored' % (snapshot, len(changed['files']), len(manifest['files'])))
+
+    # Files created after the snapshot are removed (on confirmation), so the restore is point-in-time
+    extra = sorted([path for path in current if path not in manifest['files']])
+    if extra:
+        print('Files not in snapshot %s:\n%s' % (snapshot, '\n'.join(extra)))
+        if _is_true(delete) or (delete is None and console.confirm('Delete these %d files?' % len(extra), default=False)):
+            with cd(_django_project_dir()):
+                run('rm -f -- %s' % ' '.join([shlex.quote(path) for path in extra]))
+            print('%d files not in snapshot %s deleted' % (len(extra), snapshot))
+
 
 ###################
 # Apache commands #
@@ -387,27 +1465,38 @@ def restore_database(filename):
 def install_apache():
     """Installs Apache and mod_wsgi"""
     apt_get_update()
-    sudo ('apt-get -y -qq install apache2 apache2-mpm-worker libapache2-mod-wsgi')
+    sudo(APT_INSTALL % ' '.join(APT_PACKAGES['apache']))
 
 def setup_apache():
     """Configures Apache"""
-    if files.exists(_interpolate('/etc/apache2/sites-enabled/%(virtualenv)s.conf')):
+    site = _interpolate('/etc/apache2/sites-enabled/%(virtualenv)s.conf')
+    step, probe = 'apache_site:%s' % site, 'test -e %s' % site
+    if not _pending_step(step, probe, _interpolate(APACHE_CONF)):
         print('Apache conf for %(environment)s already exists' % env)
     else:
-        sudo(_interpolate('ln -s %s /etc/apache2/sites-enabled/%%(virtualenv)s.conf' % APACHE_CONF))
+        sudo(_interpolate('ln -s %s %s' % (APACHE_CONF, site)))
         sudo('apache2ctl restart')
+        _record_step(step, probe, _interpolate(APACHE_CONF))
 
 def generate_apache_conf(django_version=None):
     """Generates Apache conf file. Requires: path to WSGI conf file."""
     _require_environment()
-
-    site_packages_dir = '%s/%s' % (_interpolate(VIRTUALENV_DIR), SITE_PACKAGES_DIR % _get_python_version())
+    capacity = _get_capacity()
+    variables = _apache_conf_variables(_get_python_version(), capacity)
+    print('WSGI sizing for %d CPUs, %dMB RAM, app RSS %dMB: %d processes x %d threads, %d Apache workers' % (
+        capacity['cpus'], capacity['memory_mb'], capacity['app_rss_mb'], variables['wsgi_processes'],
+        variables['wsgi_threads'], variables['mpm_max_request_workers']))
+    _generate_conf('apache.conf', variables, django_version)
+
+def _apache_conf_variables(python_version, capacity):
+    """Variables for Apache conf template"""
+    site_packages_dir = '%s/%s' % (_interpolate(VIRTUALENV_DIR), SITE_PACKAGES_DIR % python_version)
     config_dir        = _interpolate(CONFIG_DIR)
     host_aliases      = env.project.get('host_aliases', '')
     if host_aliases:
         host_aliases  = 'ServerAlias %s' % host_aliases
 
-    _generate_conf('apache.conf', {
+    variables = {
         'host':              env.project['host'],
         'host_aliases':      host_aliases,
         'site_packages_dir': site_packages_dir,
@@ -417,18 +1506,255 @@ def generate_apache_conf(django_version=None):
         'static_dir':        _interpolate(STATIC_DIR),
         'config_dir':        config_dir,
         'wsgi_file':         'wsgi_%s.py' % env.environment,
-    }, django_version)
+        'wsgi_script_options': '',
+    }
+    # Script loaded when daemon processes start, instead of at their first request
+    if _is_true(env.project.get('wsgi_preload', False)):
+        variables['wsgi_script_options'] = ' process-group=%s application-group=%%{GLOBAL}' % env.project['host']
+    variables.update(_wsgi_sizing(capacity))
+    return variables
+
+def _wsgi_sizing(capacity):
+    """
+    Variables for WSGIDaemonProcess and MPM worker limits, from the server's capacity (see _get_capacity):
+    one process per CPU, as long as they fit (with room to grow) in WSGI_MEMORY_SHARE of the memory.
+    Any of them can be overridden by ENVS: wsgi_processes, wsgi_threads, wsgi_maximum_requests,
+    wsgi_queue_timeout, wsgi_inactivity_timeout.
+    """
+    by_memory = int(capacity['memory_mb'] * WSGI_MEMORY_SHARE / (capacity['app_rss_mb'] * WSGI_RSS_GROWTH))
+    sizing = {
+        'wsgi_processes':          max(1, min(capacity['cpus'], by_memory)),
+        'wsgi_threads':            WSGI_THREADS,
+        'wsgi_maximum_requests':   WSGI_MAXIMUM_REQUESTS,
+        'wsgi_queue_timeout':      WSGI_QUEUE_TIMEOUT,
+        'wsgi_inactivity_timeout': WSGI_INACTIVITY_TIMEOUT,
+    }
+    for key in sizing:
+        sizing[key] = int(env.project.get(key, sizing[key]))
+
+    # Apache workers serve static files and pass requests on to WSGI processes: twice as many as WSGI threads
+    children = max(2, -(-2 * sizing['wsgi_processes'] * sizing['wsgi_threads'] // MPM_THREADS_PER_CHILD))
+    sizing.update({
+        'mpm_server_limit':       children,
+        'mpm_threads_per_child':  MPM_THREADS_PER_CHILD,
+        'mpm_max_request_workers': children * MPM_THREADS_PER_CHILD,
+    })
+    return sizing
+
+def _get_capacity():
+    """CPUs, memory and RSS of the Django app at the server (cached, see FACTS_FILE)"""
+    return _get_fact('capacity', _probe_capacity)
+
+def _probe_capacity():
+    """Checks CPUs, memory and RSS of the Django app (after loading it, as a WSGI process does), at the server"""
+    with settings(hide('commands')):
+        cpus, memory_mb = run(CAPACITY_PROBE).split()
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        with prefix(_django_prefix()):
+            with cd(_django_project_dir()):
+                result = run(APP_RSS_PROBE)
+    app_rss_mb = int(result.splitlines()[-1]) if result.succeeded and result.strip() else WSGI_DEFAULT_RSS_MB
+    return {'cpus': int(cpus), 'memory_mb': int(memory_mb), 'app_rss_mb': app_rss_mb}
 
 def generate_wsgi_conf(django_version=None):
     """Generates WSGI conf file"""
     _require_environment()
-    _generate_conf('wsgi.py', {
+    _generate_conf('wsgi.py', _wsgi_conf_variables(_get_python_version()), django_version)
+    local(_interpolate('cp %(project)s/wsgi_%(environment)s.py %(project)s/wsgi.py'))
+
+def _wsgi_conf_variables(python_version):
+    """Variables for WSGI conf template"""
+    return {
         'project': env.project['project'],
         'settings': env.project['settings'],
-        'site_packages': SITE_PACKAGES_DIR % _get_python_version(),
-    }, django_version)
-    local(_interpolate('cp %(project)s/wsgi_%(environment)s.py %(project)s/wsgi.py'))
+        'site_packages': SITE_PACKAGES_DIR % python_version,
+        'preload': WSGI_PRELOAD if _is_true(env.project.get('wsgi_preload', False)) else '',
+    }
 
+def render_confs(django_version=None, save=None, check=None):
+    """
+    Renders Apache and WSGI confs of all environments in ENVS at once, without connecting to servers (facts come from
+    ENVS or from the facts cache), and shows how they differ from the current files. Changed files are saved if
+    confirmed (or with save=yes). Use check=yes to just fail if any conf is out of date (e.g.: before a deploy).
+    """
+    check = check is not None and _is_true(check)
+    changed = []
+    for environment in sorted(ENVS):
+        project = dict(ENVS[environment], environment=environment)
+        with settings(environment=environment, project=project, host_string=_first_target(project)):
+            python_version = _offline_fact('python_version', ['python_version'])
+            capacity = _offline_fact('capacity', ['cpus', 'memory_mb', 'app_rss_mb'])
+            if not python_version or not capacity:
+                print('%s: skipped, no cached or declared Python version/capacity (e.g.: fab %s python_version '
+                      'generate_apache_conf)' % (environment, environment))
+                continue
+            confs = [
+                ('apache.conf', _apache_conf_variables(python_version, capacity)),
+                ('wsgi.py', _wsgi_conf_variables(python_version)),
+            ]
+            for conf_file, variables in confs:
+                output_file = _conf_output_file(conf_file)
+                conf = _render_conf(conf_file, variables, django_version)
+                current = ''
+                if os.path.exists(output_file):
+                    with open(output_file, 'r') as input:
+                        current = input.read()
+                if conf == current:
+                    continue
+                changed.append(output_file)
+                sys.stdout.writelines(difflib.unified_diff(current.splitlines(True), conf.splitlines(True),
+                                                           output_file, '%s (rendered)' % output_file))
+                if not check and (_is_true(save) or console.confirm('Save to %s?' % output_file, default=False)):
+                    with open(output_file, 'w') as output:
+                        output.write(conf)
+
+    if check and changed:
+        abort('%d conf file(s) out of date: %s' % (len(changed), ', '.join(changed)))
+    print('%d conf file(s) differ from templates' % len(changed) if changed else 'All conf files up to date')
+
+def _first_target(project):
+    """First host of an environment, as in Fabric's host list (see _setup_environment)"""
+    if project.get('hosts', None):
+        return project['hosts'][0]
+    for hosts in project.get('roles', {}).values():
+        if hosts:
+            return hosts[0]
+    return project['host']
+
+def _offline_fact(name, declared):
+    """Fact declared in ENVS (a single value, or a dictionary of several keys) or cached (even if expired), without probing"""
+    if all([key in env.project for key in declared]):
+        if len(declared) == 1:
+            return env.project[declared[0]]
+        return dict([(key, env.project[key]) for key in declared])
+    fact = _load_facts().get(_facts_key(), {}).get(name, None)
+    return fact['value'] if fact else None
+
+def _rolling(action, deploy=False):
+    """
+    Decorator for tasks that reset the app: with ENVS 'rolling', when such a task is invoked from the command
+    line for several hosts, it's replaced by a rolling_restart with the given action. Deploy tasks (deploy=True)
+    still run on all hosts, but without resetting the app (see _reset_deferred), and the rolling_restart follows
+    once all hosts are updated.
+    """
+    def actual_decorator(task):
+        @functools.wraps(task)
+        def wrapper(*args, **kwargs):
+            all_hosts = env.get('all_hosts') or []
+            if (not env.project.get('rolling', False) or env.command != task.__name__ or len(all_hosts) < 2 or
+                    (deploy and env.parallel)):
+                return task(*args, **kwargs)
+            if env.host_string != all_hosts[0]:
+                return
+            if deploy:
+                with settings(rolling_deploy=True):
+                    task(*args, **kwargs)
+            rolling_restart(action)
+        return wrapper
+    return actual_decorator
+
+def _reset_deferred():
+    """Whether a deploy task must leave the app as it is, to be reset by a rolling_restart afterwards (see _rolling)"""
+    return env.get('rolling_deploy', False)
+
+def rolling_restart(action='graceful', batch_size=None, min_capacity=None):
+    """
+    Resets the app on all hosts, a batch at a time, with action 'graceful' (reloads Apache) or 'touch' (WSGI file).
+    Each batch must pass the health probe, and is then warmed up (see ENVS 'warmup_urls'), before the next one starts;
+    the rollout halts at the first failure.
+    Batches are small enough to keep min_capacity (fraction of hosts, see ENVS 'rolling_min_capacity') serving.
+    """
+    _require_environment()
+    all_hosts = env.get('all_hosts') or [env.host_string]
+    if env.host_string != all_hosts[0]:
+        return
+    if action not in ('graceful', 'touch'):
+        abort('Unknown action %s - use graceful or touch' % action)
+    min_capacity = float(min_capacity or env.project.get('rolling_min_capacity', ROLLING_MIN_CAPACITY))
+    largest = max(1, len(all_hosts) - int(-(-len(all_hosts) * min_capacity // 1)))
+    batch_size = min(int(batch_size or largest), largest)
+    print('Rolling %s of %d hosts, %d at a time' % (action, len(all_hosts), batch_size))
+
+    for start in range(0, len(all_hosts), batch_size):
+        batch = all_hosts[start:start + batch_size]
+        for host in batch:
+            with settings(host_string=host):
+                if action == 'graceful':
+                    sudo('apache2ctl graceful')
+                else:
+                    run(_interpolate('touch %s' % WSGI_CONF))
+        unhealthy = _wait_healthy(batch)
+        if unhealthy:
+            abort('Rollout halted: %s not healthy. Reset: %s. Not reset: %s' % (
+                ', '.join(unhealthy), ', '.join(all_hosts[:start + batch_size]) or '-',
+                ', '.join(all_hosts[start + batch_size:]) or '-'))
+        for host in batch:
+            with settings(host_string=host):
+                _warm_up_after_reset()
+
+def _wait_healthy(hosts):
+    """
+    Probes hosts until each one answers ENVS 'health_url' (requested at the server itself) with a success or
+    redirect, within the latency budget. Returns the hosts that did not do so within the timeout.
+    """
+    budget = float(env.project.get('health_budget', HEALTH_BUDGET))
+    probe = HEALTH_PROBE % {'budget': budget * 5, 'host': env.project['host'], 'url': env.project.get('health_url', HEALTH_URL)}
+    deadline = time.time() + float(env.project.get('health_timeout', HEALTH_TIMEOUT))
+    pending = list(hosts)
+    while pending and time.time() < deadline:
+        for host in list(pending):
+            with settings(hide('commands', 'warnings'), host_string=host, warn_only=True):
+                result = run(probe)
+            status, elapsed = (result.split() + ['000', '0'])[:2] if result.succeeded else ('000', '0')
+            healthy = 200 <= int(status) < 400 and float(elapsed) <= budget
+            print('[%s] health: HTTP %s in %.2fs%s' % (host, status, float(elapsed), '' if healthy else ', waiting'))
+            if healthy:
+                pending.remove(host)
+        if pending:
+            time.sleep(2)
+    return pending
+
+def warm_up(*urls):
+    """
+    Requests URLs (default: ENVS 'warmup_urls') at the server with enough concurrent requests to reach every WSGI
+    daemon process, in two rounds, and reports latency of the first one (cold) against the second one (warm).
+    """
+    _require_environment()
+    urls = list(urls) or env.project.get('warmup_urls', None) or [HEALTH_URL]
+    concurrency = int(env.project.get('warmup_concurrency', 0))
+    if not concurrency:
+        sizing = _wsgi_sizing(_get_capacity())
+        concurrency = sizing['wsgi_processes'] * sizing['wsgi_threads']
+    probe = WARMUP_PROBE % {'concurrency': concurrency, 'urls': ' '.join([shlex.quote(url) for url in urls]),
+                            'timeout': WARMUP_TIMEOUT, 'host': env.project['host']}
+
+    timings = dict([(url, {'cold': [], 'warm': [], 'failed': 0}) for url in urls])
+    for stage in ('cold', 'warm'):
+        with settings(hide('commands', 'stdout', 'warnings'), warn_only=True):
+            result = run(probe)
+        for line in result.splitlines():
+            parts = line.split()
+            if len(parts) != 3 or parts[0] not in timings:
+                continue
+            if 200 <= int(parts[1]) < 400:
+                timings[parts[0]][stage].append(float(parts[2]))
+            else:
+                timings[parts[0]]['failed'] += 1
+
+    latency = lambda values: '%dms/%dms' % (_percentile(values, 50) * 1000, values[-1] * 1000) if values else '-'
+    print('[%s] warm-up, %d concurrent requests per URL, cold -> warm (median/max):' % (env.host_string, concurrency))
+    for url in urls:
+        cold, warm = sorted(timings[url]['cold']), sorted(timings[url]['warm'])
+        failed = timings[url]['failed']
+        print('  %s: %s -> %s%s' % (url, latency(cold), latency(warm), ', %d failed' % failed if failed else ''))
+
+def _warm_up_after_reset():
+    """Warms up the app just reset, if there are ENVS 'warmup_urls'"""
+    if env.project.get('warmup_urls', None):
+        warm_up()
+
+@_rolling('graceful')
+@_fan_out
 def apache_restart():
     """
     Restarts Apache
@@ -446,18 +1772,30 @@ def install_python():
     _require_environment()
     # TODO: Install Python from source, regardless of Linux distribution
     apt_get_update()
-    sudo('apt-get -y -qq install python python2.7 python2.7-dev pkg-config gcc')
-    sudo('apt-get -y -qq install python-setuptools python-bs4')
-    sudo('easy_install pip')
-    sudo('pip install virtualenv')
-    sudo('pip install virtualenvwrapper')
-    with settings(warn_only=True):
-        sudo(_interpolate('mkdir -p %(workon)s'))
-        sudo(_interpolate('chmod g+w %(workon)s'))
-        sudo(_interpolate('chown %%(user)s:%%(user)s %(workon)s') % env)
+    sudo(APT_INSTALL % ' '.join(APT_PACKAGES['python']))
+    _run_steps(_virtualenvwrapper_steps() + _workon_steps(), False)
+
+def _virtualenvwrapper_steps():
+    """Steps (see _run_steps) that install pip, virtualenv and virtualenvwrapper"""
+    return [
+        ('easy_install pip', False, True),
+        ('pip install virtualenv virtualenvwrapper', False, True),
+    ]
+
+def _workon_steps():
+    """Steps (see _run_steps) that create the parent dir of virtualenvs (workon), writable by the user"""
+    return [
+        (_interpolate('mkdir -p %(workon)s'), True, True),
+        (_interpolate('chmod g+w %(workon)s'), True, True),
+        (_interpolate('chown %%(user)s:%%(user)s %(workon)s') % env, True, True),
+    ]
 
 def _get_python_version():
-    """Checks python version on remote virtualenv"""
+    """Checks python version on remote virtualenv (cached, see FACTS_FILE)"""
+    return _get_fact('python_version', _probe_python_version)
+
+def _probe_python_version():
+    """Checks python version on remote virtualenv, at the server"""
     with settings(hide('commands', 'warnings'), warn_only=True):
         # First tries to check python within virtualenv
         with prefix(_django_prefix()):
@@ -468,7 +1806,7 @@ def _get_python_version():
         # if it still fails, something is wrong!
         if result.failed:
             abort(_interpolate('Could not determine Python version at virtualenv %(virtualenv)s'))
-    return result
+    return str(result)
 
 def _virtualenvwrapper_prefix():
     """Prefix to be able to invoke virtualenvwrapper commands"""
@@ -479,13 +1817,17 @@ def _virtualenvwrapper_prefix():
 
 def _setup_virtualenv():
     """Creates virtualenv for environment"""
-    if files.exists(_interpolate(VIRTUALENV_DIR)):
+    virtualenv_dir = _interpolate(VIRTUALENV_DIR)
+    step, probe = 'virtualenv:%s' % virtualenv_dir, 'test -d %s' % virtualenv_dir
+    if not _pending_step(step, probe, virtualenv_dir):
         print(_interpolate('virtualenv %(virtualenv)s already exists'))
     else:
+        _invalidate_facts()
         with prefix(_virtualenvwrapper_prefix()):
             run(_interpolate('mkvirtualenv --no-site-packages %(virtualenv)s'))
             with hide('commands'):
                 print('virtualenv %s created with python %s\n' % (env.project['virtualenv'], run(GET_PYTHON_VERSION)))
+        _record_step(step, probe, virtualenv_dir)
 
 def python_version():
     """Tries to figure out Python version on server side"""
@@ -508,32 +1850,93 @@ def _clone_gitrepo():
     """Clones project git repo into virtualenv"""
     # Puts git repo in ~/.ssh/config to avoid interaction due to missing known_hosts
     git_server = urllib.splituser(urllib.splittype(env.project['git_repo'])[0])[1]
-    if not files.exists('~/.ssh/config') or not files.contains('~/.ssh/config', git_server):
+    step, probe = 'ssh_config:%s' % git_server, 'grep -qs %s ~/.ssh/config' % shlex.quote(git_server)
+    if _pending_step(step, probe, git_server):
         files.append('~/.ssh/config', ['host %s' % git_server, '    StrictHostKeyChecking no'])
+        _record_step(step, probe, git_server)
 
     branch = env.project.get('git_branch', 'master')
-    if files.exists(_interpolate(DJANGO_PROJECT_DIR)):
+    project_dir = _django_project_dir()
+    step, probe = 'git_clone:%s' % project_dir, 'test -e %s' % project_dir
+    if not _pending_step(step, probe, env.project['git_repo']):
         print(_interpolate('project %(project)s already exists, updating'))
-        remote('git pull origin %s' % branch)
+        for command, warn_only in _git_update_commands(branch):
+            with settings(warn_only=warn_only):
+                remote(command)
     else:
+        # Shallow/partial clone (ENVS 'git_depth', 'git_filter'), or clone borrowing objects of the shared repo
+        options = '--branch %s' % branch
+        if env.project.get('git_shared_objects', False):
+            options += ' --reference %s' % _update_git_shared_repo()
+        else:
+            if env.project.get('git_depth', None):
+                options += ' --depth %s' % env.project['git_depth']
+            if env.project.get('git_filter', None):
+                options += ' --filter=%s' % env.project['git_filter']
         with cd(_interpolate(VIRTUALENV_DIR)):
-            run(_interpolate('git clone %(git_repo)s %(project)s'))
-            if branch != 'master':
-                remote('git fetch origin %s:%s' % (branch, branch))
-                remote('git checkout %s' % branch)
+            run(_interpolate('git clone %s %%(git_repo)s %%(project)s' % options))
+        _record_step(step, probe, env.project['git_repo'])
 
-def django_version():
-    """Checks installed Django version"""
-    _require_environment()
+def _git_shared_repo():
+    """Location of the bare repo at the server that keeps git objects shared by all environments"""
+    return '%s/%s.git' % (GIT_SHARED_DIR, re.sub(r'[^\w.-]+', '_', env.project['git_repo']))
+
+def _update_git_shared_repo():
+    """Creates or updates (all branches, with a single fetch) the shared repo, see _git_shared_repo"""
+    run(_git_shared_repo_command())
+    return _git_shared_repo()
+
+def _git_shared_repo_command():
+    """
+    Command that creates the shared repo, or updates it (failing to do so is just a warning: the update of
+    the environment's repo from it then brings nothing new)
+    """
+    shared_repo = _git_shared_repo()
+    # Clones of environments depend on these objects: never prune them
+    return ('if [ -e %(repo)s ]; then git -C %(repo)s fetch -q origin "+refs/heads/*:refs/heads/*" || '
+            'echo "Warning: could not update %(repo)s" >&2; else mkdir -p %(dir)s && git clone -q --bare %(url)s %(repo)s && '
+            'git -C %(repo)s config gc.pruneExpire never; fi' % {
+                'repo': shared_repo, 'dir': GIT_SHARED_DIR, 'url': env.project['git_repo']})
+
+def _git_update_commands(branch):
+    """
+    (command, warn_only) steps (at project's dir level) that update the working copy with a single fetch: from
+    origin, or from the shared repo, that is updated first and then lends its objects to this environment's repo.
+    The branch is fetched first if it's not in the working copy yet, and merged only if fetched.
+    """
+    source = 'origin'
+    commands = []
+    if env.project.get('git_shared_objects', False):
+        source = _git_shared_repo()
+        alternates = '.git/objects/info/alternates'
+        # Repos cloned before 'git_shared_objects' start borrowing its objects, and drop their own copies
+        commands.append((_git_shared_repo_command(), False))
+        commands.append(('grep -qsx %s/objects %s || (echo %s/objects >> %s && git repack -a -d -l -q)' % (
+            source, alternates, source, alternates), False))
+    commands.append(('(git show-ref -q --verify refs/heads/%s || git fetch %s %s:%s) && git checkout %s' % (
+        branch, source, branch, branch, branch), False))
+    # As git pull used to be, a failed update (e.g.: conflicts) is just a warning
+    commands.append(('git fetch %s %s && git merge FETCH_HEAD' % (source, branch), True))
+    return commands
+
+def _get_django_version():
+    """Checks installed Django version (cached, see FACTS_FILE)"""
+    return _get_fact('django_version', _probe_django_version)
+
+def _probe_django_version():
+    """Checks installed Django version, at the server"""
     with settings(hide('commands', 'warnings'), warn_only=True):
         with prefix(_django_prefix()):
             with cd(_django_project_dir()):
-                with settings(hide('warnings'), warn_only=True):
-                    result = run('django-admin --version')
+                result = run('django-admin --version')
     if result.failed:
         abort(_interpolate('Could not determine Django version at virtualenv %(virtualenv)s'))
-    else:
-        print('Django version on virtualenv %s: %s' % (env.project['virtualenv'], result))
+    return str(result)
+
+def django_version():
+    """Checks installed Django version"""
+    _require_environment()
+    print('Django version on virtualenv %s: %s' % (env.project['virtualenv'], _get_django_version()))
 
 def extra_commands():
     """Issue commands contained in env.project['EXTRA_COMMANDS']"""
@@ -553,9 +1956,11 @@ def remote(command):
             else:
                 run(_parse_alias(command))
 
-def setup_project():
-    """Sets up a new environment"""
+def setup_project(verify=None):
+    """Sets up a new environment (steps already done are skipped; use verify=yes to re-check them first)"""
     _require_environment()
+    if verify is not None and _is_true(verify):
+        verify_state()
 
     # Checks if needed conf files for this environment already exist
     settings_file = _interpolate('%(project)s/%(settings)s.py')
@@ -586,59 +1991,393 @@ def setup_project():
 
     # Install Python packages & Django
     pip_install()
-    update_project()
+    update_project(force='yes')
 
-def pip_install():
-    """Uses pip to install needed requirements"""
+@_fan_out
+def pip_install(wheelhouse=None):
+    """Uses pip to install needed requirements (use wheelhouse=yes to install offline from prebuilt wheels)"""
     _require_environment()
-    remote(_interpolate(PIP_INSTALL_PREFIX))
+    if _wheelhouse_mode(wheelhouse):
+        if not _pip_install_wheelhouse():
+            return
+    else:
+        remote(_interpolate(PIP_INSTALL_PREFIX))
+    _invalidate_facts('python_version', 'django_version')
+
+def _wheelhouse_mode(wheelhouse):
+    """Should requirements be installed from a wheelhouse? Task parameter has precedence over ENVS 'wheelhouse'"""
+    if wheelhouse is None:
+        return bool(env.project.get('wheelhouse', False))
+    return _is_true(wheelhouse)
+
+def _wheelhouse_key():
+    """Identifies the wheels needed by this host: hash of requirements file, Python version and OS platform"""
+    with settings(hide('commands')):
+        with cd(_django_project_dir()):
+            digest = run(_interpolate('sha256sum %s | cut -c-16' % PIP_REQUIREMENTS))
+        platform = run(OS_PLATFORM)
+    return '%s-py%s-%s' % (digest, _get_python_version(), platform)
 
+def _pip_install_wheelhouse():
+    """
+    Installs requirements offline, from the wheelhouse archive (see _wheelhouse), unless the virtualenv
+    already has them. Returns True if something was installed.
+    """
+    key = _wheelhouse_key()
+    marker = _interpolate(WHEELHOUSE_MARKER)
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        installed = run('cat %s' % marker)
+    if installed.succeeded and installed == key:
+        print('Requirements already installed from wheelhouse %s' % key)
+        return False
+
+    remote_archive, packages = _wheelhouse(key)
+    # Libraries that compiled extensions (e.g.: mysqlclient) need, at hosts other than the one that built the wheels
+    _install_runtime_packages(packages)
+    wheels_dir = remote_archive[:-len('.tar')]
+    run('mkdir -p %s && tar -xf %s -C %s' % (wheels_dir, remote_archive, wheels_dir))
+    remote(_interpolate('pip install --no-index --find-links=%s -r %s' % (wheels_dir, PIP_REQUIREMENTS)))
+    run('echo %s > %s && rm -rf %s %s' % (key, marker, wheels_dir, remote_archive))
+    return True
+
+def _wheelhouse(key):
+    """
+    Puts the wheelhouse archive for key at the server. If it's not in the local cache (WHEELHOUSE_DIR) yet,
+    builds it at this server and keeps a copy, so other hosts (and new ones) get the same wheels.
+    Returns the location of the archive at the server, and the packages that the wheels need at runtime.
+    """
+    archive = os.path.join(WHEELHOUSE_DIR, '%s.tar' % key)
+    packages_file = os.path.join(WHEELHOUSE_DIR, '%s.packages' % key)
+    remote_archive = '%s/wheelhouse-%s.tar' % (REMOTE_HELPERS_DIR, key)
+    run('mkdir -p %s' % REMOTE_HELPERS_DIR)
+    if not os.path.exists(WHEELHOUSE_DIR):
+        os.makedirs(WHEELHOUSE_DIR, exist_ok=True)
+    with open(archive + '.lock', 'w') as lock:
+        # Hosts handled in parallel (see _fan_out) wait for the first one to build the archive
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(archive) or not os.path.exists(packages_file):
+            build_dir = remote_archive[:-len('.tar')]
+            remote(_interpolate('pip wheel -r %s -w %s' % (PIP_REQUIREMENTS, build_dir)))
+            run('tar -cf %s -C %s . && mkdir %s/unpacked && cd %s/unpacked && '
+                'for wheel in ../*.whl; do python -m zipfile -e $wheel .; done' % (
+                    remote_archive, build_dir, build_dir, build_dir))
+            packages = _runtime_packages('%s/unpacked' % build_dir)
+            run('rm -rf %s' % build_dir)
+            get(remote_archive, archive + '.part')
+            with open(packages_file, 'w') as output:
+                output.write('\n'.join(packages))
+            os.rename(archive + '.part', archive)
+            return remote_archive, packages
+    put(archive, remote_archive)
+    with open(packages_file, 'r') as input:
+        return remote_archive, input.read().split()
+
+@_rolling('touch')
+@_fan_out
 def touch_project():
-    """Touches WSGI file to reset Apache"""
+    """Touches WSGI file to reset Apache (and warms it up, see ENVS 'warmup_urls')"""
     remote(_interpolate('touch %s' % WSGI_CONF))
+    _warm_up_after_reset()
 
 def status_project():
     """Checks git log and status"""
     remote('glogg -n 20 && echo "" && git status')
 
-def update_project():
-    """Updates server from git pull"""
+@_rolling('touch', deploy=True)
+@_fan_out
+def update_project(batch=None, force=None):
+    """
+    Updates server from git pull, then installs requirements, migrates, collects static and touches WSGI file
+    only if needed (use force=yes to always migrate, collect static and touch). Use batch=yes to issue all
+    commands in a single round trip (implies force).
+    """
     _require_environment()
+    log_dir = '%s/log' % _interpolate(VIRTUALENV_DIR)
+    branch = env.project.get('git_branch', 'master')
+
+    # Release mode: no git at the server, see deploy_release
+    if env.project.get('releases', None):
+        deploy_release()
+        if not _reset_deferred():
+            _warm_up_after_reset()
+        return
+
+    # Batched: grants rights on log dir, updates from git, migrates, resets Apache, collects static
+    if _batch_mode(batch):
+        with prefix(_django_prefix()):
+            with cd(_django_project_dir()):
+                _run_batch(
+                    [('[ ! -e %s ] || %schmod -R g+w %s' % (log_dir, env.sudo_prefix % env, log_dir), False, False)] +
+                    [(command, warn_only, False) for command, warn_only in _git_update_commands(branch)] + [
+                    ('django-admin migrate', True, False)] +
+                    ([] if _reset_deferred() else [(_interpolate('touch %s' % WSGI_CONF), True, False)]) + [
+                    ('django-admin collectstatic --noinput', True, False),
+                ])
+        if not _reset_deferred():
+            _warm_up_after_reset()
+        return
 
     # Grants write rights on log dir for the admin group
-    log_dir = '%s/log' % _interpolate(VIRTUALENV_DIR)
-    if files.exists(log_dir):
-        sudo('chmod -R g+w %s' % log_dir)
+    sudo('[ ! -e %s ] || chmod -R g+w %s' % (log_dir, log_dir))
 
-    # Updates from git, issues Django syncdb, South migrate, Collecstatic and resets Apache
-    branch = env.project.get('git_branch', 'master')
+    # Updates from git, and finds out what changed
+    force = force is not None and _is_true(force)
     with prefix(_django_prefix()):
         with cd(_django_project_dir()):
-            with settings(hide('warnings'), warn_only=True):
-                run('git fetch origin %s:%s' % (branch, branch))
-            run('git checkout %s' % branch)
-            with settings(hide('warnings'), warn_only=True):
-                run('git pull origin %s' % branch)
-                # run('django-admin syncdb') deprecated since Django 1.9
-                run('django-admin migrate')
-                run(_interpolate('touch %s' % WSGI_CONF))
-                run('django-admin collectstatic --noinput')
-
-def check_log():
-    """Tails Django log"""
-    _require_environment()
+            with settings(hide('commands')):
+                before = run('git rev-parse HEAD')
+            for command, warn_only in _git_update_commands(branch):
+                with settings(hide('warnings'), warn_only=warn_only):
+                    run(command)
+            with settings(hide('commands')):
+                after = run('git rev-parse HEAD')
+                changed = run('git diff --name-only %s %s' % (before, after)).split() if before != after else []
+
+    # Installs requirements, issues Django migrate, Collecstatic and resets Apache - if needed
+    # (pip_install is not forced: it was never part of update_project)
+    pip = _update_step('pip_install', False, 'requirements changed' if _interpolate(PIP_REQUIREMENTS) in changed else None)
+    if pip:
+        pip_install()
     with prefix(_django_prefix()):
         with cd(_django_project_dir()):
-            logfile = '../log/%s.log' % env.project['project']
-            run('tail -100f %s' % logfile)
+            with settings(hide('warnings'), warn_only=True):
+                unapplied = False
+                if not force and not pip:
+                    with settings(hide('commands', 'stdout')):
+                        unapplied = run('django-admin migrate --check').failed
+                migrate = _update_step('migrate', force,
+                                       'requirements changed' if pip else 'unapplied migrations' if unapplied else None)
+                if migrate:
+                    # run('django-admin syncdb') deprecated since Django 1.9
+                    run('django-admin migrate')
+                static = [path for path in changed if path.startswith('static/') or '/static/' in path]
+                restart = _update_step('restart', force, 'code changed' if before != after else 'migrated' if migrate else None)
+                restart = restart and not _reset_deferred()
+                if restart:
+                    run(_interpolate('touch %s' % WSGI_CONF))
+                if _update_step('collectstatic', force,
+                                'requirements changed' if pip else '%d static files changed' % len(static) if static else None):
+                    run('django-admin collectstatic --noinput')
+    if restart:
+        _warm_up_after_reset()
+
+def _update_step(step, force, reason):
+    """Logs whether step of update_project is going to run (forced, or there is a reason for it) or not"""
+    if force:
+        reason = 'forced'
+    print('[%s] update_project: %s %s (%s)' % (env.host_string, 'running' if reason else 'skipping', step,
+                                              reason or 'nothing changed'))
+    return bool(reason)
+
+@_rolling('touch', deploy=True)
+@_fan_out
+def deploy_release(revision=None):
+    """
+    Deploys a release: code of git revision (default: origin's git_branch) plus collected static, built locally
+    once, uploaded to each host, migrated and then switched to atomically. Keeps older releases for rollback_release.
+    """
+    _require_environment()
+    rev, artifact = _build_release(revision)
+    release_dir = '%s/%s' % (_interpolate(RELEASES_DIR), rev)
 
+    # Uploads and unpacks release, with media shared by all releases
+    if files.exists(release_dir):
+        print('Release %s already at server' % rev)
+        run('touch %s' % release_dir)
+    else:
+        shared_media_dir = _share_media()
+        run('mkdir -p %s.part' % release_dir)
+        _upload(artifact, '%s.tar.gz' % release_dir)
+        run('tar -xzf %s.tar.gz -C %s.part && rm %s.tar.gz' % (release_dir, release_dir, release_dir))
+        run('rm -rf %s.part/media && ln -s %s %s.part/media && mv %s.part %s' % (
+            release_dir, shared_media_dir, release_dir, release_dir, release_dir))
+
+    # Installs requirements (if they changed) and migrates with the new release, while the site still runs the current one
+    # (the virtualenv is shared by all releases: rollback_release does not undo requirement changes)
+    requirements = _interpolate(PIP_REQUIREMENTS)
+    with settings(hide('commands', 'warnings'), warn_only=True):
+        changed = run('cmp -s %s/%s %s/%s' % (_django_project_dir(), requirements, release_dir, requirements)).failed
+    with prefix(_django_prefix()):
+        with cd(release_dir):
+            if changed:
+                run(_interpolate(PIP_INSTALL_PREFIX))
+                _invalidate_facts('python_version', 'django_version')
+            run('export PYTHONPATH=%s:$PYTHONPATH && django-admin migrate' % release_dir)
+
+    _switch_release(rev)
+
+    # Removes old releases
+    keep = int(env.project.get('releases', None) or RELEASES_KEEP)
+    with cd(_interpolate(RELEASES_DIR)):
+        run('ls -1t | grep -v -x -e %s | grep -v "\\.part$" | tail -n +%d | xargs -r rm -rf' % (rev, keep))
+
+@_rolling('touch', deploy=True)
+@_fan_out
+def rollback_release(release=None):
+    """
+    Switches back to the previous release (or to the given one). Does not undo migrations, nor requirement changes:
+    all releases share the virtualenv, so packages installed by a later release stay (see pip_install).
+    """
+    _require_environment()
+    with cd(_interpolate(RELEASES_DIR)):
+        with settings(hide('commands')):
+            current = os.path.basename(run('readlink %s' % _django_project_dir()))
+            if not release:
+                release = run('ls -1t | grep -v -x -e %s | grep -v "\\.part$" | head -n 1' % current)
+            if not release or not files.exists(release):
+                abort('There is no release %s to roll back to - available: %s' % (release, run('ls -1t | xargs')))
+        requirements = _interpolate(PIP_REQUIREMENTS)
+        with settings(hide('commands', 'warnings'), warn_only=True):
+            if run('cmp -s %s/%s %s/%s' % (current, requirements, release, requirements)).failed:
+                print('[%s] Warning: requirements of %s differ from the installed ones (%s) - run pip_install if needed' % (
+                    env.host_string, release, current))
+    _switch_release(release)
+
+def _build_release(revision=None):
+    """
+    Builds locally (once for all hosts) the artifact of a git revision: code plus collected static.
+    Returns (short revision, path to artifact).
+    """
+    if not os.path.exists(RELEASES_STORE_DIR):
+        os.makedirs(RELEASES_STORE_DIR, exist_ok=True)
+    with open(os.path.join(RELEASES_STORE_DIR, '.lock'), 'w') as lock:
+        # Hosts handled in parallel (see _fan_out) wait for the first one to build the artifact
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not revision:
+            branch = env.project.get('git_branch', 'master')
+            local('git fetch -q origin %s' % branch)
+            revision = 'origin/%s' % branch
+        rev = local('git rev-parse --short %s' % revision, capture=True)
+        artifact = os.path.join(RELEASES_STORE_DIR, '%s-%s.tar.gz' % (env.project['project'], rev))
+        if os.path.exists(artifact):
+            return rev, artifact
+
+        build_dir = tempfile.mkdtemp(prefix='fabmanager-release-')
+        try:
+            local('git archive %s | tar -x -C %s' % (rev, build_dir))
+            # Static is collected with project's settings, except for STATIC_ROOT
+            with open(os.path.join(build_dir, '_release_settings.py'), 'w') as output:
+                output.write(RELEASE_SETTINGS % dict(env.project, static_root=os.path.join(build_dir, 'static')))
+            with lcd(build_dir):
+                with shell_env(PYTHONPATH=build_dir, DJANGO_SETTINGS_MODULE='_release_settings'):
+                    local('django-admin collectstatic --noinput -v 0')
+            os.remove(os.path.join(build_dir, '_release_settings.py'))
+            local('tar -czf %s.part -C %s .' % (artifact, build_dir))
+            os.rename('%s.part' % artifact, artifact)
+        finally:
+            shutil.rmtree(build_dir)
+    return rev, artifact
+
+def _share_media():
+    """
+    Prepares the media dir shared by all releases. At the first release at this server, the git checkout's media
+    is moved there (as long as the shared dir is missing or empty), before anything else creates it.
+    """
+    project_dir = _django_project_dir()
+    shared_media_dir = _interpolate(SHARED_MEDIA_DIR)
+    run('mkdir -p %s' % os.path.dirname(shared_media_dir))
+    if not files.is_link(project_dir) and files.exists(project_dir):
+        run('if [ -d %(project)s/media ] && [ ! -L %(project)s/media ] && [ -z "$(ls -A %(shared)s 2>/dev/null)" ]; then '
+            '[ ! -d %(shared)s ] || rmdir %(shared)s; mv %(project)s/media %(shared)s && ln -s %(shared)s %(project)s/media; fi' % {
+                'project': project_dir, 'shared': shared_media_dir})
+    run('mkdir -p %s' % shared_media_dir)
+    return shared_media_dir
+
+def _switch_release(release):
+    """Atomically points project's dir to release, and touches WSGI file to reset Apache (unless _reset_deferred)"""
+    project_dir = _django_project_dir()
+
+    # First release at this server: moves the git checkout to releases dir (its media was shared by _share_media)
+    if not files.is_link(project_dir) and files.exists(project_dir):
+        checkout = 'checkout-%s' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        run('mv %s %s/%s && ln -s releases/%s %s' % (
+            project_dir, _interpolate(RELEASES_DIR), checkout, checkout, project_dir))
+
+    run('ln -sfn releases/%s %s.next && mv -T %s.next %s' % (release, project_dir, project_dir, project_dir))
+    if not _reset_deferred():
+        run(_interpolate('touch %s' % WSGI_CONF))
+    print('[%s] Switched to release %s' % (env.host_string, release))
+
+def check_log(level=None, pattern=None):
+    """
+    Tails Django log on all hosts of the environment, merged by timestamp. Optionally only lines with a minimum
+    level (e.g.: level=warning) and/or matching a (case insensitive) regular expression - filtered at the server
+    """
+    _require_environment()
+    all_hosts = env.get('all_hosts') or [env.host_string]
+    if env.host_string != all_hosts[0]:
+        return
+
+    # Filters at the server, so only matching lines are transferred
+    command = 'tail -n 100 -F %s' % shlex.quote(_interpolate(LOG_DIR + '/%(project)s.log'))
+    if level:
+        levels = _log_levels(level)
+        command += ' | grep --line-buffered -E %s' % shlex.quote('\\b(%s)\\b' % '|'.join(levels))
+    if pattern:
+        command += ' | grep --line-buffered -i -E %s' % shlex.quote(pattern)
+
+    # One reader thread per host, never blocking: if the buffer is full, lines are dropped (and counted)
+    lines = queue.Queue(LOG_FOLLOW_BUFFER)
+    dropped = [0]
+    def follow(host, channel):
+        for line in channel.makefile('rb'):
+            try:
+                lines.put_nowait((time.time(), host, line.decode('utf-8', 'replace').rstrip()))
+            except queue.Full:
+                dropped[0] += 1
+    for host in all_hosts:
+        with settings(host_string=host):
+            thread = threading.Thread(target=follow, args=(host, _open_channel(command)))
+        thread.daemon = True
+        thread.start()
+
+    # Lines wait LOG_FOLLOW_WINDOW to be sorted by timestamp; lines without timestamp follow the previous one
+    pending = []
+    last_timestamps = {}
+    sequence = 0
+    while True:
+        try:
+            arrival, host, line = lines.get(timeout=LOG_FOLLOW_WINDOW / 2)
+            match = logsearch.TIMESTAMP.match(line)
+            if match:
+                last_timestamps[host] = ' '.join(match.groups())
+            sequence += 1
+            heapq.heappush(pending, (last_timestamps.get(host, ''), sequence, arrival, host, line))
+        except queue.Empty:
+            pass
+        while pending and pending[0][2] < time.time() - LOG_FOLLOW_WINDOW:
+            timestamp, order, arrival, host, line = heapq.heappop(pending)
+            print('[%s] %s' % (host, line))
+        if dropped[0]:
+            print('[... %d lines dropped ...]' % dropped[0])
+            dropped[0] = 0
+
+
+def _log_levels(level):
+    """Levels from level up (see logsearch.levels_from), aborting if level is unknown"""
+    try:
+        return logsearch.levels_from(level)
+    except ValueError as e:
+        abort(str(e))
 
-def find_in_log(string):
-    """Finds string parameter in Django logs"""
+def find_in_log(string, since=None, until=None, level=None, limit=100, regex=None):
+    """
+    Finds string parameter in Django logs (including rotated .gz/.zst ones), using an index kept at the server.
+    Optionally within a time range (e.g.: since=1h, until='2024-01-31 18:00'), with a minimum level (e.g.: level=error),
+    up to limit lines. Use regex=yes if string is a regular expression.
+    """
     _require_environment()
-    with prefix(_django_prefix()):
-        with cd(_django_project_dir()):
-            run('grep -i %s ../log/*' % string)
+    if level:
+        _log_levels(level)
+    _upload_helper(logsearch)
+    options = ['--limit %d' % int(limit)]
+    for option, value in (('since', since), ('until', until), ('level', level)):
+        if value:
+            options.append('--%s %s' % (option, shlex.quote(value)))
+    if regex and _is_true(regex):
+        options.append('--regex')
+    run('python3 %s/logsearch.py %s %s %s %s' % (
+        REMOTE_HELPERS_DIR, _interpolate(LOG_INDEX), _interpolate(LOG_DIR), shlex.quote(string), ' '.join(options)))
 
 
 #####################
@@ -650,9 +2389,29 @@ def bootstrap(username, password):
     _require_environment()
 
     adduser(username, password)
-    hostname(env.project['project'])
-    install_python()
+    mysql_password = prompt('Password for MySQL root?', default='')
+
+    # Plan: packages of all install_* tasks in a single apt transaction, at the same time as the steps that do
+    # not depend on it, then the steps that do - all in one remote script
+    packages = []
+    for task, task_packages in APT_PACKAGES.items():
+        packages.extend([package for package in task_packages if package not in packages])
+    plan = [
+        # Concurrent sudo commands would all prompt at once: authenticates first (same tty, so sudo remembers it)
+        ('Authenticate sudo', [('true', False, True)]),
+        ('Update apt repositories (unless done today)', [_apt_get_update_step()]),
+        ('At once: install %d packages (%s), set hostname, create workon dir' % (len(packages), ', '.join(APT_PACKAGES)),
+         [_concurrently([[(APT_INSTALL % ' '.join(packages), False, True)],
+                         _hostname_steps(env.project['project']), _workon_steps()])]),
+        ('Install pip, virtualenv, virtualenvwrapper', _virtualenvwrapper_steps()),
+        ('Set MySQL root password', _mysql_password_steps(mysql_password)),
+    ]
+    print('Bootstrap plan for %s:' % env.host_string)
+    for index, (description, steps) in enumerate(plan):
+        print('    %d. %s' % (index + 1, description))
+    print('    %d. Build git from source, if needed (install_git)' % (len(plan) + 1))
+    print('    %d. Set up project (setup_project)' % (len(plan) + 2))
+    _run_batch([step for description, steps in plan for step in steps])
+
     install_git()
-    install_apache()
-    install_mysql()
     setup_project()
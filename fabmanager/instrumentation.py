@@ -0,0 +1,141 @@
+# encoding: utf-8
+# Timing of remote operations, for run reports
+#
+# Once installed, every run()/sudo() (including the ones issued by fabric.contrib, e.g. files.exists)
+# and every put()/get() is recorded with its wall-clock time, exit status, bytes transferred, and the
+# task and fabfile function that issued it. At the end of the fab invocation, a JSON report is written
+# and the slowest steps are printed.
+#
+# Operations issued by worker processes (see decorators._fan_out) are sent back to the main process
+# along with the task's result, and merged (see merge).
+
+import atexit
+import datetime
+import json
+import os
+import sys
+import time
+
+from fabric import operations
+from fabric import sftp
+from fabric.api import env
+
+REPORTS_DIR   = os.path.expanduser('~/.fabmanager/reports')
+SLOWEST_STEPS = 15
+
+# Operations recorded in this invocation
+OPERATIONS = []
+
+def _caller():
+    """Name of the innermost function of a fabfile (fabmanager's or the project's) in the call stack"""
+    frame = sys._getframe(2)
+    while frame:
+        code = frame.f_code
+        if os.path.basename(code.co_filename).startswith('fabfile') and code.co_name != '<module>':
+            return code.co_name
+        frame = frame.f_back
+    return None
+
+def _record(operation, description, start, succeeded, size):
+    """Records an operation that has just finished"""
+    elapsed = time.time() - start
+    OPERATIONS.append({
+        'host': env.host_string,
+        'task': env.get('command', None),
+        'function': _caller(),
+        'operation': operation,
+        'description': description,
+        'start': start,
+        'elapsed': elapsed,
+        'succeeded': succeeded,
+        'bytes': size,
+    })
+
+def _file_size(path, is_path):
+    """Size of local file, if it's a path (put/get may be given file-like objects)"""
+    try:
+        return os.path.getsize(path) if is_path else None
+    except OSError:
+        return None
+
+def _timed_command(run_command):
+    """Wraps fabric.operations._run_command, used by both run() and sudo()"""
+    def wrapper(command, *args, **kwargs):
+        start = time.time()
+        result = None
+        try:
+            result = run_command(command, *args, **kwargs)
+            return result
+        finally:
+            _record('sudo' if kwargs.get('sudo', False) else 'run', command, start,
+                    result is not None and result.return_code == 0, len(result) if result is not None else None)
+    return wrapper
+
+def _timed_put(put):
+    """Wraps fabric.sftp.SFTP.put, used by put()"""
+    def wrapper(self, local_path, remote_path, use_sudo, mirror_local_mode, mode, local_is_path, *args, **kwargs):
+        start = time.time()
+        succeeded = False
+        try:
+            result = put(self, local_path, remote_path, use_sudo, mirror_local_mode, mode, local_is_path, *args, **kwargs)
+            succeeded = True
+            return result
+        finally:
+            _record('put', '%s -> %s' % (local_path if local_is_path else '<file>', remote_path), start, succeeded,
+                    _file_size(local_path, local_is_path))
+    return wrapper
+
+def _timed_get(get):
+    """Wraps fabric.sftp.SFTP.get, used by get()"""
+    def wrapper(self, remote_path, local_path, use_sudo, local_is_path, *args, **kwargs):
+        start = time.time()
+        succeeded = False
+        try:
+            result = get(self, remote_path, local_path, use_sudo, local_is_path, *args, **kwargs)
+            succeeded = True
+            return result
+        finally:
+            _record('get', '%s -> %s' % (remote_path, local_path if local_is_path else '<file>'), start, succeeded,
+                    _file_size(local_path, local_is_path))
+    return wrapper
+
+def merge(operations):
+    """Adds operations recorded by a worker process, keeping all of them in order of start"""
+    OPERATIONS.extend(operations)
+    OPERATIONS.sort(key=lambda operation: operation['start'])
+
+def install():
+    """Starts recording remote operations, and reporting them at exit. Can be called more than once."""
+    if getattr(operations._run_command, 'instrumented', False):
+        return
+    operations._run_command = _timed_command(operations._run_command)
+    sftp.SFTP.put = _timed_put(sftp.SFTP.put)
+    sftp.SFTP.get = _timed_get(sftp.SFTP.get)
+    operations._run_command.instrumented = True
+    atexit.register(report)
+
+def report():
+    """Writes JSON report of this invocation to REPORTS_DIR, and prints the slowest steps"""
+    if not OPERATIONS:
+        return
+    started = datetime.datetime.fromtimestamp(OPERATIONS[0]['start'])
+    filename = os.path.join(REPORTS_DIR, '%s_%s_%s.json' % (
+        started.strftime('%Y%m%d-%H%M%S'), env.get('environment', None), env.get('command', None)))
+    if not os.path.exists(REPORTS_DIR):
+        os.makedirs(REPORTS_DIR)
+    with open(filename, 'w') as output:
+        json.dump({
+            'environment': env.get('environment', None),
+            'command': env.get('command', None),
+            'started': started.isoformat(),
+            'elapsed': time.time() - OPERATIONS[0]['start'],
+            'operations': OPERATIONS,
+        }, output, indent=1)
+
+    print('\nSlowest steps:')
+    for operation in sorted(OPERATIONS, key=lambda operation: -operation['elapsed'])[:SLOWEST_STEPS]:
+        print('%8.2fs %-4s %-20s %-25s %s%s' % (
+            operation['elapsed'], operation['operation'], operation['host'], operation['function'],
+            operation['description'][:80], '' if operation['succeeded'] else ' (FAILED)'))
+    print('Total %.1fs in %d remote operations, report saved to %s' % (
+        sum([operation['elapsed'] for operation in OPERATIONS]), len(OPERATIONS), filename))
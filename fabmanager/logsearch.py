@@ -0,0 +1,279 @@
+# encoding: utf-8
+# Indexed search of Django logs, used by find_in_log
+#
+# Runs at the server as a standalone script (Python 3, stdlib only), uploaded and invoked by fabfile.py:
+#
+#   python3 logsearch.py <index dir> <log dir> <string> [--since T] [--until T] [--level L] [--limit N] [--regex]
+#
+# Log files (including rotated .gz/.zst ones) are split in blocks of BLOCK_SIZE bytes of text. For each
+# block, the index keeps the range of timestamps found in it and a bloom filter of its trigrams, so that
+# only blocks within the time range that may contain the string have to be read. The index is updated
+# incrementally: rotated files are indexed once, and only new blocks of growing files are read.
+#
+# The index is a dir with a small catalog (CATALOG_FILE: time range and shard of each log file) and a shard
+# per log file: a JSON line with its blocks, followed by their bloom filters in binary. Only shards of files
+# that changed are rewritten, and only shards of files within the time range are read by a search.
+
+import argparse
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import zlib
+
+BLOCK_SIZE   = 1024 * 1024
+BLOOM_BITS   = 1 << 18
+BLOOM_BYTES  = BLOOM_BITS // 8
+BLOOM_HASHES = 2
+CATALOG_FILE = 'catalog.json'
+
+# Timestamps as written by Django's logging (asctime), e.g.: 2024-01-31 13:45:01,123
+TIMESTAMP    = re.compile(r'(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+LEVELS       = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+LEVEL        = re.compile(r'\b(%s)\b' % '|'.join(LEVELS))
+RELATIVE     = re.compile(r'^(\d+)([smhd])$')
+
+class _Decompressed(object):
+    """Output of a decompressing process as a binary stream, checking how the process ended when closed"""
+
+    def __init__(self, command, path):
+        self.command = command
+        self.path = path
+        self.process = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self.process.stdout
+
+    def __exit__(self, type, value, traceback):
+        # Output left: reading stopped before the end (e.g.: limit of lines reached), so the result doesn't matter
+        stopped = type is not None or self.process.stdout.read(1) != b''
+        self.process.stdout.close()
+        if stopped:
+            self.process.kill()
+        return_code = self.process.wait()
+        if not stopped and return_code != 0:
+            raise IOError('%s failed on %s (exit code %d)' % (self.command[0], self.path, return_code))
+
+def _open(path):
+    """Binary stream of a log file, decompressing it if needed"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        return _Decompressed(['zstd', '-dcq'], path)
+    return open(path, 'rb')
+
+def _skip_to(input, position, offset):
+    """Moves input from position to offset: seeks plain files, reads through compressed ones"""
+    if isinstance(input, io.BufferedReader) and input.seekable():
+        input.seek(offset)
+    else:
+        while position < offset:
+            position += len(input.read(min(offset - position, BLOCK_SIZE)))
+    return offset
+
+def _blocks(path, offset=0):
+    """Generates (offset, lines) of blocks of about BLOCK_SIZE bytes of file, starting at offset"""
+    with _open(path) as input:
+        _skip_to(input, 0, offset)
+        lines = []
+        length = 0
+        for line in input:
+            lines.append(line.decode('utf-8', 'replace'))
+            length += len(line)
+            if length >= BLOCK_SIZE:
+                yield offset, length, lines
+                offset += length
+                lines = []
+                length = 0
+        if lines:
+            yield offset, length, lines
+
+def _bloom_positions(trigram):
+    """Bits of the bloom filter corresponding to trigram"""
+    data = trigram.encode('utf-8')
+    return [zlib.crc32(data, seed) % BLOOM_BITS for seed in range(BLOOM_HASHES)]
+
+def _trigrams(text):
+    """All (lowercase) sequences of three characters in text"""
+    text = text.lower()
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+def _index_block(offset, length, lines):
+    """Index entry for a block of lines, and its bloom filter"""
+    bloom = bytearray(BLOOM_BYTES)
+    for trigram in _trigrams(''.join(lines)):
+        for position in _bloom_positions(trigram):
+            bloom[position >> 3] |= 1 << (position & 7)
+    timestamps = [' '.join(match.groups()) for match in map(TIMESTAMP.match, lines) if match]
+    block = {
+        'offset': offset,
+        'length': length,
+        'start': min(timestamps) if timestamps else None,
+        'end': max(timestamps) if timestamps else None,
+    }
+    return block, bytes(bloom)
+
+def _read_shard(shard_file, blooms=True):
+    """Blocks of a shard, and their bloom filters (unless blooms=False)"""
+    with open(shard_file, 'rb') as input:
+        blocks = json.loads(input.readline().decode('utf-8'))
+        if not blooms:
+            return blocks, []
+        data = input.read()
+    return blocks, [data[i * BLOOM_BYTES:(i + 1) * BLOOM_BYTES] for i in range(len(blocks))]
+
+def _write_file(filename, data):
+    """Replaces file atomically (searches may run at the same time)"""
+    temp_file = '%s.%d' % (filename, os.getpid())
+    with open(temp_file, 'wb') as output:
+        output.write(data)
+    os.replace(temp_file, filename)
+
+def _load_catalog(index_dir):
+    """Catalog of indexed log files: path -> inode, size, shard and range of timestamps"""
+    try:
+        with open(os.path.join(index_dir, CATALOG_FILE), 'r') as input:
+            return json.load(input)
+    except (IOError, ValueError):
+        return {}
+
+def update_index(index_dir, log_dir):
+    """Indexes new log files, and new blocks of log files that grew, rewriting only their shards"""
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    catalog = _load_catalog(index_dir)
+    updated = {}
+    for filename in sorted(os.listdir(log_dir)):
+        path = os.path.join(log_dir, filename)
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entry = catalog.get(path, None)
+        shard_file = os.path.join(index_dir, '%s.idx' % filename)
+        if entry and entry['inode'] == stat.st_ino and entry['size'] == stat.st_size and os.path.exists(shard_file):
+            updated[path] = entry
+            continue
+        blocks, blooms = [], []
+        compressed = path.endswith('.gz') or path.endswith('.zst')
+        if entry and entry['inode'] == stat.st_ino and entry['size'] < stat.st_size and not compressed \
+                and os.path.exists(shard_file):
+            # File grew: re-indexes its last (possibly partial) block onwards
+            blocks, blooms = _read_shard(shard_file)
+            blocks, blooms = blocks[:-1], blooms[:-1]
+        offset = blocks[-1]['offset'] + blocks[-1]['length'] if blocks else 0
+        try:
+            for offset, length, lines in _blocks(path, offset):
+                block, bloom = _index_block(offset, length, lines)
+                blocks.append(block)
+                blooms.append(bloom)
+        except IOError as e:
+            # Not indexed (nor searched) this time
+            sys.stderr.write('Skipping %s: %s\n' % (path, e))
+            continue
+        _write_file(shard_file, json.dumps(blocks).encode('utf-8') + b'\n' + b''.join(blooms))
+        starts = [block['start'] for block in blocks if block['start']]
+        ends = [block['end'] for block in blocks if block['end']]
+        updated[path] = {'inode': stat.st_ino, 'size': stat.st_size, 'shard': os.path.basename(shard_file),
+                         'start': min(starts) if starts else None, 'end': max(ends) if ends else None}
+
+    # Forgets log files that are gone
+    for path, entry in catalog.items():
+        if path not in updated:
+            try:
+                os.remove(os.path.join(index_dir, entry['shard']))
+            except OSError:
+                pass
+    if updated != catalog:
+        _write_file(os.path.join(index_dir, CATALOG_FILE), json.dumps(updated).encode('utf-8'))
+    return updated
+
+def _parse_time(value, now):
+    """Absolute (YYYY-MM-DD[ HH:MM[:SS]]) or relative to now (e.g.: 30m, 1h, 2d) time, as a timestamp string"""
+    if not value:
+        return None
+    match = RELATIVE.match(value)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        value = (now - datetime.timedelta(**{unit: int(match.group(1))})).strftime('%Y-%m-%d %H:%M:%S')
+    return value.replace('T', ' ')
+
+def _in_range(entry, since, until):
+    """Whether a log file or block (entry with start/end timestamps) may have lines within time range"""
+    if since and entry['end'] and entry['end'] < since:
+        return False
+    if until and entry['start'] and entry['start'] > until:
+        return False
+    return True
+
+def levels_from(level):
+    """Levels from level up (e.g.: 'warning' -> WARNING, ERROR, CRITICAL), raising ValueError for unknown levels"""
+    if level.upper() not in LEVELS:
+        raise ValueError('Unknown level %s; use one of %s' % (level, ', '.join(LEVELS).lower()))
+    return LEVELS[LEVELS.index(level.upper()):]
+
+def search(index_dir, catalog, string, since=None, until=None, level=None, limit=100, regex=False, output=sys.stdout):
+    """Writes to output the lines matching string (case insensitive) within time range and minimum level"""
+    pattern = re.compile(string if regex else re.escape(string), re.IGNORECASE)
+    positions = [] if regex else [position for trigram in _trigrams(string) for position in _bloom_positions(trigram)]
+    levels = levels_from(level) if level else None
+    found = 0
+    for path, entry in sorted(catalog.items(), key=lambda item: item[1]['start'] or ''):
+        if not _in_range(entry, since, until):
+            continue
+        blocks, blooms = _read_shard(os.path.join(index_dir, entry['shard']), blooms=bool(positions))
+        selected = []
+        for index, block in enumerate(blocks):
+            if not _in_range(block, since, until):
+                continue
+            if all([blooms[index][position >> 3] >> (position & 7) & 1 for position in positions]):
+                selected.append(block)
+        if not selected:
+            continue
+
+        # Reads selected blocks only (compressed files have to be read sequentially anyway)
+        with _open(path) as input:
+            position = 0
+            for block in selected:
+                position = _skip_to(input, position, block['offset']) + block['length']
+                timestamp = block['start']
+                for line in input.read(block['length']).decode('utf-8', 'replace').splitlines():
+                    match = TIMESTAMP.match(line)
+                    if match:
+                        timestamp = ' '.join(match.groups())
+                    if since and timestamp and timestamp < since or until and timestamp and timestamp > until:
+                        continue
+                    if levels:
+                        match = LEVEL.search(line)
+                        if not match or match.group(1) not in levels:
+                            continue
+                    if pattern.search(line):
+                        output.write('%s: %s\n' % (os.path.basename(path), line))
+                        found += 1
+                        if found >= limit:
+                            return found
+    return found
+
+def main(argv):
+    """Invoked at the server, see usage above"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index')
+    parser.add_argument('log_dir')
+    parser.add_argument('string')
+    parser.add_argument('--since')
+    parser.add_argument('--until')
+    parser.add_argument('--level', type=str.upper, choices=LEVELS)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--regex', action='store_true')
+    args = parser.parse_args(argv[1:])
+    now = datetime.datetime.now()
+    catalog = update_index(args.index, args.log_dir)
+    found = search(args.index, catalog, args.string, _parse_time(args.since, now), _parse_time(args.until, now),
+                   args.level, args.limit, args.regex)
+    sys.stderr.write('%d line(s) found%s\n' % (found, ' (limit reached)' if found >= args.limit else ''))
+
+if __name__ == '__main__':
+    main(sys.argv)
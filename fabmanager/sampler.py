@@ -0,0 +1,115 @@
+# encoding: utf-8
+# Continuous sampling of resource usage, used by sample_resources
+#
+# Runs at the server as a standalone script (Python 3, stdlib only), uploaded and invoked by fabfile.py:
+#
+#   python3 sampler.py <interval> <top>
+#
+# Every interval seconds, reads /proc and prints one line of JSON with CPU, memory, disk I/O, network
+# and the top processes by CPU usage during the interval.
+
+import json
+import os
+import sys
+import time
+
+def _cpu_times():
+    """(busy, iowait, total) jiffies of all CPUs"""
+    with open('/proc/stat') as input:
+        values = [int(value) for value in input.readline().split()[1:]]
+    idle, iowait = values[3], values[4]
+    total = sum(values[:8])
+    return total - idle - iowait, iowait, total
+
+def _memory():
+    """Used memory and swap, in MB"""
+    info = {}
+    with open('/proc/meminfo') as input:
+        for line in input:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) // 1024
+    return info['MemTotal'] - info.get('MemAvailable', info['MemFree']), info['SwapTotal'] - info['SwapFree']
+
+def _disk_sectors():
+    """(read, written) sectors of all whole disks"""
+    read = written = 0
+    with open('/proc/diskstats') as input:
+        for line in input:
+            fields = line.split()
+            name = fields[2]
+            if name.startswith(('loop', 'ram', 'dm-')) or not os.path.exists('/sys/block/%s' % name):
+                continue
+            read += int(fields[5])
+            written += int(fields[9])
+    return read, written
+
+def _network_bytes():
+    """(received, sent) bytes of all interfaces, except loopback"""
+    received = sent = 0
+    with open('/proc/net/dev') as input:
+        for line in input.readlines()[2:]:
+            name, data = line.split(':', 1)
+            if name.strip() == 'lo':
+                continue
+            fields = data.split()
+            received += int(fields[0])
+            sent += int(fields[8])
+    return received, sent
+
+def _load():
+    """Load average of the last minute"""
+    with open('/proc/loadavg') as input:
+        return float(input.read().split()[0])
+
+def _process_times():
+    """Dictionary pid -> (command, jiffies, RSS in MB) of all processes"""
+    processes = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as input:
+                data = input.read()
+        except IOError:
+            continue
+        command = data[data.index('(') + 1:data.rindex(')')]
+        fields = data[data.rindex(')') + 2:].split()
+        processes[pid] = (command, int(fields[11]) + int(fields[12]), int(fields[21]) * page_size // (1024 * 1024))
+    return processes
+
+def sample(interval, top, output=sys.stdout):
+    """Prints one sample per interval, forever"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    previous = (_cpu_times(), _disk_sectors(), _network_bytes(), _process_times(), time.time())
+    while True:
+        time.sleep(interval)
+        current = (_cpu_times(), _disk_sectors(), _network_bytes(), _process_times(), time.time())
+        (busy, iowait, total), (read, written), (received, sent), processes, now = current
+        (busy_, iowait_, total_), (read_, written_), (received_, sent_), processes_, then = previous
+        elapsed = now - then
+        cpu_total = float(total - total_ or 1)
+        memory, swap = _memory()
+        usage = []
+        for pid, (command, jiffies, rss) in processes.items():
+            if pid in processes_:
+                usage.append((100.0 * (jiffies - processes_[pid][1]) / ticks / elapsed, command, pid, rss))
+        output.write(json.dumps({
+            'time': now,
+            'cpu': round(100 * (busy - busy_) / cpu_total, 1),
+            'iowait': round(100 * (iowait - iowait_) / cpu_total, 1),
+            'load': _load(),
+            'memory_mb': memory,
+            'swap_mb': swap,
+            'disk_read_mbs': round((read - read_) * 512 / 1e6 / elapsed, 2),
+            'disk_write_mbs': round((written - written_) * 512 / 1e6 / elapsed, 2),
+            'net_in_mbs': round((received - received_) / 1e6 / elapsed, 2),
+            'net_out_mbs': round((sent - sent_) / 1e6 / elapsed, 2),
+            'top': [{'pid': pid, 'command': command, 'cpu': round(cpu, 1), 'rss_mb': rss}
+                    for cpu, command, pid, rss in sorted(usage, reverse=True)[:top]],
+        }) + '\n')
+        output.flush()
+        previous = current
+
+if __name__ == '__main__':
+    sample(float(sys.argv[1]), int(sys.argv[2]))
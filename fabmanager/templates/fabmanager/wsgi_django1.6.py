@@ -6,3 +6,4 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', '%(project)s.%(settings)s')
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+%(preload)s